@@ -0,0 +1,656 @@
+"""salon_karute.py のオフラインベンチマーク.
+
+Google Sheets / Drive の代わりにプロセス内の偽物 (API 呼び出しごとの遅延とクォータエラーを
+注入できる) を使い、顧客数・施術履歴数を変えて主な処理のスループット・p50/p99 レイテンシ・
+API 呼び出し回数を測る。本物の Google API には一切接続しない。
+
+    python benchmark.py
+    python benchmark.py --sizes 1000 10000 100000 --latency-ms 80 --quota-error-rate 0.01
+    python benchmark.py --sizes 10000 --json result.json
+
+顔認証のシナリオは合成画像を使う (顔は写っていない) ため、face_login は顔検出で終わる経路、
+face_match は登録済み特徴量との照合だけを測る。
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import gspread
+import httplib2
+import numpy as np
+import requests
+from googleapiclient.errors import HttpError
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FAMILY_NAMES = [("山田", "ヤマダ"), ("佐藤", "サトウ"), ("鈴木", "スズキ"), ("高橋", "タカハシ"), ("田中", "タナカ"),
+                ("伊藤", "イトウ"), ("渡辺", "ワタナベ"), ("中村", "ナカムラ"), ("小林", "コバヤシ"), ("加藤", "カトウ")]
+GIVEN_NAMES = [("花子", "ハナコ"), ("太郎", "タロウ"), ("美咲", "ミサキ"), ("陽菜", "ヒナ"), ("翔太", "ショウタ"),
+               ("結衣", "ユイ"), ("大輔", "ダイスケ"), ("さくら", "サクラ"), ("健", "ケン"), ("愛", "アイ")]
+TREATMENT_NAMES = ["カット", "カラー", "パーマ", "トリートメント", "ヘッドスパ", "縮毛矯正", "ブリーチ"]
+MEMO_WORDS = ["短め", "前髪", "ボブ", "レイヤー", "明るめ", "暗め", "ゆるめ", "しっかり", "次回", "カラー相談"]
+
+
+# ---------------------------------------------------------------------------
+# 偽の Google バックエンド
+# ---------------------------------------------------------------------------
+
+def gspread_quota_error():
+    response = requests.Response()
+    response.status_code = 429
+    response._content = json.dumps(
+        {"error": {"code": 429, "message": "Quota exceeded (benchmark)", "status": "RESOURCE_EXHAUSTED"}}
+    ).encode()
+    return gspread.exceptions.APIError(response)
+
+
+def http_quota_error():
+    return HttpError(httplib2.Response({"status": 429}), b"Quota exceeded (benchmark)")
+
+
+def _column_number(letters):
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - 64
+    return number
+
+
+def _parse_a1(a1):
+    """"A2:F" や "1:1" を (開始行, 終了行, 開始列, 終了列) にする (省略された端は None)."""
+    match = re.fullmatch(r"([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?", a1.split("!")[-1])
+    col1, row1, col2, row2 = match.groups()
+    return (int(row1) if row1 else 1, int(row2) if row2 else None,
+            _column_number(col1) if col1 else 1, _column_number(col2) if col2 else None)
+
+
+class FakeBackend:
+    """API 呼び出しの回数を数え、遅延とクォータエラーを注入する."""
+
+    def __init__(self, latency, quota_error_rate, seed):
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.quota_errors = Counter()  # 注入した 429 の回数
+        self.books = {}
+        self.files = {}
+
+    def call(self, name):
+        """API 呼び出し1回分の遅延を入れる。クォータエラーにするなら True を返す."""
+        with self.lock:
+            self.calls[name] += 1
+            fail = self.random.random() < self.quota_error_rate
+            if fail:
+                self.quota_errors[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return fail
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.calls), sum(self.quota_errors.values())
+
+
+class FakeWorksheet:
+    """gspread.Worksheet のうちアプリが使う部分."""
+
+    def __init__(self, backend, title, sheet_id, rows):
+        self.backend = backend
+        self.title = title
+        self.id = sheet_id
+        self.rows = rows
+        self.lock = threading.Lock()
+
+    def _call(self, method):
+        if self.backend.call(f"sheets.{method}"):
+            raise gspread_quota_error()
+
+    @property
+    def col_count(self):
+        with self.lock:
+            return max((len(row) for row in self.rows), default=0)
+
+    def add_cols(self, count):
+        self._call("add_cols")
+
+    def get_all_values(self):
+        self._call("get_all_values")
+        with self.lock:
+            width = max((len(row) for row in self.rows), default=0)
+            return [row + [""] * (width - len(row)) for row in self.rows]
+
+    def get_all_records(self):
+        self._call("get_all_records")
+        with self.lock:
+            headers = self.rows[0] if self.rows else []
+            return [dict(zip(headers, row + [""] * (len(headers) - len(row)))) for row in self.rows[1:]]
+
+    def _get_range(self, a1):
+        row1, row2, col1, col2 = _parse_a1(a1)
+        values = [list(row[col1 - 1:col2]) for row in self.rows[row1 - 1:row2]]
+        while values and not any(values[-1]):
+            values.pop()
+        return values
+
+    def batch_get(self, ranges, **kwargs):
+        self._call("batch_get")
+        with self.lock:
+            return [self._get_range(a1) for a1 in ranges]
+
+    def _set(self, row, col, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = value
+
+    def batch_update(self, data, **kwargs):
+        self._call("batch_update")
+        with self.lock:
+            for update in data:
+                row1, _, col1, _ = _parse_a1(update["range"])
+                for i, values in enumerate(update["values"]):
+                    for j, value in enumerate(values):
+                        self._set(row1 + i, col1 + j, value)
+
+    def cell(self, row, col):
+        self._call("cell")
+        with self.lock:
+            cells = self.rows[row - 1] if row - 1 < len(self.rows) else []
+            return gspread.Cell(row, col, cells[col - 1] if col - 1 < len(cells) else "")
+
+
+class FakeSpreadsheet:
+    def __init__(self, spreadsheet_id, worksheets):
+        self.id = spreadsheet_id
+        self.worksheets = {worksheet.title: worksheet for worksheet in worksheets}
+
+    @property
+    def sheet1(self):
+        return next(iter(self.worksheets.values()))
+
+    def worksheet(self, title):
+        if title not in self.worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def values_batch_get(self, ranges, params=None):
+        """"'シート名'!A2:F" や "'シート名'" の範囲をまとめて返す (1回の呼び出しとして数える)."""
+        if self.sheet1.backend.call("sheets.values_batch_get"):
+            raise gspread_quota_error()
+        value_ranges = []
+        for name in ranges:
+            title, separator, a1 = name.rpartition("!")
+            if not separator:
+                title, a1 = a1, ""
+            worksheet = self.worksheet(title[1:-1].replace("''", "'") if title.startswith("'") else title)
+            with worksheet.lock:
+                value_ranges.append({"range": name, "values": worksheet._get_range(a1)})
+        return {"spreadsheetId": self.id, "valueRanges": value_ranges}
+
+
+class FakeRequest:
+    def __init__(self, backend, name, run):
+        self.backend = backend
+        self.name = name
+        self.run = run
+
+    def execute(self, num_retries=0):
+        if self.backend.call(self.name):
+            raise http_quota_error()
+        return self.run()
+
+
+class FakeSheetsService:
+    """Sheets API v4 の spreadsheets().batchUpdate (書き込みキューが使う)."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def batchUpdate(self, spreadsheetId, body):
+        return FakeRequest(self.backend, "sheets.batchUpdate", lambda: self._apply(spreadsheetId, body))
+
+    def _apply(self, spreadsheet_id, body):
+        book = next(book for book in self.backend.books.values() if book.id == spreadsheet_id)
+        worksheets = {worksheet.id: worksheet for worksheet in book.worksheets.values()}
+        for request in body.get("requests", []):
+            if "appendCells" in request:
+                append = request["appendCells"]
+                worksheet = worksheets[append["sheetId"]]
+                with worksheet.lock:
+                    for row in append["rows"]:
+                        worksheet.rows.append([cell["userEnteredValue"]["stringValue"] for cell in row["values"]])
+            elif "updateCells" in request:
+                update = request["updateCells"]
+                grid = update["range"]
+                worksheet = worksheets[grid["sheetId"]]
+                with worksheet.lock:
+                    for j, cell in enumerate(update["rows"][0]["values"]):
+                        worksheet._set(grid["startRowIndex"] + 1, grid["startColumnIndex"] + 1 + j,
+                                       cell["userEnteredValue"]["stringValue"])
+            elif "deleteDimension" in request:
+                grid = request["deleteDimension"]["range"]
+                worksheet = worksheets[grid["sheetId"]]
+                with worksheet.lock:
+                    del worksheet.rows[grid["startIndex"]:grid["endIndex"]]
+        return {"spreadsheetId": spreadsheet_id, "replies": []}
+
+
+class FakeMediaHttp:
+    """MediaIoBaseDownload が呼ぶ http.request (Range ヘッダーに応じて分割して返す)."""
+
+    def __init__(self, backend, file_id):
+        self.backend = backend
+        self.file_id = file_id
+
+    def request(self, uri, method="GET", headers=None, **kwargs):
+        if self.backend.call("drive.get_media"):
+            return httplib2.Response({"status": 429}), b"Quota exceeded (benchmark)"
+        data = self.backend.files[self.file_id]["data"]
+        start, end = (int(x) for x in re.match(r"bytes=(\d+)-(\d+)", headers["range"]).groups())
+        chunk = data[start:end + 1]
+        return httplib2.Response({
+            "status": 206, "content-range": f"bytes {start}-{start + len(chunk) - 1}/{len(data)}",
+        }), chunk
+
+
+class FakeMediaRequest:
+    def __init__(self, backend, file_id):
+        self.uri = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+        self.headers = {}
+        self.http = FakeMediaHttp(backend, file_id)
+
+
+class FakeUploadRequest:
+    """files().create: 通常のアップロード (execute) と再開可能なアップロード (next_chunk)."""
+
+    def __init__(self, backend, body, media_body):
+        self.backend = backend
+        self.body = body
+        self.media = media_body
+        self.position = 0
+
+    def _create(self):
+        data = self.media.getbytes(0, self.media.size())
+        with self.backend.lock:
+            file_id = f"file{len(self.backend.files):06d}"
+            self.backend.files[file_id] = {
+                "data": data, "name": self.body.get("name"), "appProperties": self.body.get("appProperties", {}),
+                "modifiedTime": "2024-01-01T00:00:00.000Z",
+            }
+        return {"id": file_id}
+
+    def execute(self, num_retries=0):
+        if self.backend.call("drive.create"):
+            raise http_quota_error()
+        return self._create()
+
+    def next_chunk(self, num_retries=0):
+        from googleapiclient.http import MediaUploadProgress
+        for attempt in range(num_retries + 1):
+            if not self.backend.call("drive.upload_chunk"):
+                break
+            if attempt == num_retries:
+                raise http_quota_error()
+        self.position = min(self.position + self.media.chunksize(), self.media.size())
+        if self.position < self.media.size():
+            return MediaUploadProgress(self.position, self.media.size()), None
+        return None, self._create()
+
+
+class FakeDriveService:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def files(self):
+        return self
+
+    def get(self, fileId, fields=None):
+        def run():
+            file = self.backend.files.get(fileId)
+            if file is None:
+                raise HttpError(httplib2.Response({"status": 404}), b"File not found")
+            return {
+                "id": fileId, "name": file["name"], "md5Checksum": hashlib.md5(file["data"]).hexdigest(),
+                "modifiedTime": file["modifiedTime"], "appProperties": file["appProperties"],
+                "webViewLink": f"https://drive.google.com/file/d/{fileId}/view",
+            }
+        return FakeRequest(self.backend, "drive.get", run)
+
+    def get_media(self, fileId):
+        return FakeMediaRequest(self.backend, fileId)
+
+    def create(self, body, media_body, fields=None):
+        return FakeUploadRequest(self.backend, body, media_body)
+
+
+class FakeClient:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open(self, name):
+        if self.backend.call("sheets.open"):
+            raise gspread_quota_error()
+        if name not in self.backend.books:
+            raise gspread.exceptions.SpreadsheetNotFound(name)
+        return self.backend.books[name]
+
+
+class FakeGoogleResources:
+    """salon_karute.GoogleResources と同じインターフェースで偽のバックエンドを返す."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.client = FakeClient(backend)
+        self.opened = {}
+
+    def spreadsheet(self, name):
+        if name not in self.opened:
+            self.opened[name] = self.client.open(name)
+        return self.opened[name]
+
+    def worksheet(self, spreadsheet_name, worksheet_name=None):
+        spreadsheet = self.spreadsheet(spreadsheet_name)
+        return spreadsheet.sheet1 if worksheet_name is None else spreadsheet.worksheet(worksheet_name)
+
+    def service(self, api, version):
+        return FakeDriveService(self.backend) if api == "drive" else FakeSheetsService(self.backend)
+
+
+# ---------------------------------------------------------------------------
+# テストデータ
+# ---------------------------------------------------------------------------
+
+def customer_rows(count, rng):
+    rows = [["顧客名", "フリガナ", "電話番号", "住所", "メモ", "ID"]]
+    for i in range(count):
+        family, family_kana = FAMILY_NAMES[i % len(FAMILY_NAMES)]
+        given, given_kana = GIVEN_NAMES[(i // len(FAMILY_NAMES)) % len(GIVEN_NAMES)]
+        rows.append([f"{family} {given}{i}", f"{family_kana} {given_kana}", f"090-{i // 10000:04d}-{i % 10000:04d}",
+                     "東京都", rng.choice(MEMO_WORDS), f"c{i:011d}"])
+    return rows
+
+
+def treatment_rows(customers, count, rng):
+    rows = [["顧客名", "施術内容", "日付", "写真", "施術メモ", "ID"]]
+    start = np.datetime64("2018-01-01")
+    days = sorted(rng.randrange(0, 365 * 7) for _ in range(count))  # 施術履歴は日付順に追記される
+    for i, day in enumerate(days):
+        customer = customers[rng.randrange(1, len(customers))]
+        memo = " ".join(rng.sample(MEMO_WORDS, 2))
+        rows.append([customer[0], rng.choice(TREATMENT_NAMES), str(start + day), "", memo, f"t{i:011d}"])
+    return rows
+
+
+def face_image(rng):
+    """照合用の合成画像 (ぼかしたノイズの模様。ユーザーごとに違う特徴点が出る)."""
+    import cv2
+    noise = np.random.default_rng(rng.randrange(2 ** 32)).integers(0, 255, (120, 160), dtype=np.uint8)
+    image = cv2.resize(cv2.GaussianBlur(noise, (5, 5), 0), (640, 480), interpolation=cv2.INTER_CUBIC)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+# ---------------------------------------------------------------------------
+# 計測
+# ---------------------------------------------------------------------------
+
+class Result:
+    def __init__(self, size, scenario, samples, errors, total, calls, quota_errors):
+        self.size = size
+        self.scenario = scenario
+        self.samples = samples
+        self.errors = errors
+        self.total = total
+        self.calls = calls
+        self.quota_errors = quota_errors
+
+    def as_dict(self):
+        samples = np.array(self.samples) * 1000 if self.samples else np.array([0.0])
+        return {
+            "size": self.size,
+            "scenario": self.scenario,
+            "ops": len(self.samples),
+            "errors": self.errors,
+            "quota_errors": self.quota_errors,
+            "total_s": round(self.total, 4),
+            "ops_per_s": round(len(self.samples) / self.total, 1) if self.total else None,
+            "p50_ms": round(float(np.percentile(samples, 50)), 3),
+            "p99_ms": round(float(np.percentile(samples, 99)), 3),
+            "api_calls": dict(sorted(self.calls.items())),
+        }
+
+
+def measure(backend, size, scenario, operation, iterations, setup=None, finish=None):
+    """operation を iterations 回実行してレイテンシを集める.
+
+    setup は各回の前に計測の外で、finish は最後に計測の内側で (書き込みキューの送信待ちなど) 実行する。
+    """
+    samples, errors = [], 0
+    calls_before, quota_errors_before = backend.snapshot()
+    started = time.perf_counter()
+    setup_time = 0.0
+    for i in range(iterations):
+        if setup:
+            setup_started = time.perf_counter()
+            setup(i)
+            setup_time += time.perf_counter() - setup_started
+        op_started = time.perf_counter()
+        try:
+            if operation(i) is False:
+                errors += 1
+        except Exception as e:
+            errors += 1
+            print(f"  [{scenario}] {type(e).__name__}: {e}", file=sys.stderr)
+        samples.append(time.perf_counter() - op_started)
+    if finish:
+        finish()
+    total = time.perf_counter() - started - setup_time
+    calls, quota_errors = backend.snapshot()
+    calls.subtract(calls_before)
+    return Result(size, scenario, samples, errors, total, +calls, quota_errors - quota_errors_before)
+
+
+def run_size(sk, backend, size, args):
+    """顧客 size 人・施術履歴 size * ratio 件のデータで各シナリオを実行する."""
+    import streamlit as st
+
+    rng = random.Random(args.seed + size)
+    customers = customer_rows(size, rng)
+    treatments = treatment_rows(customers, size * args.treatments_per_customer, rng)
+    users = [["Email", "Password", "FaceID"]]
+    backend.files.clear()
+    for i in range(args.face_users):
+        file_id = f"face{i:05d}"
+        backend.files[file_id] = {"data": face_image(rng), "name": f"{file_id}.jpg", "appProperties": {},
+                                  "modifiedTime": "2024-01-01T00:00:00.000Z"}
+        users.append([f"staff{i}@example.com", sk.hash_password(f"password{i}"), file_id])
+    resources = FakeGoogleResources(backend)
+    sk.get_google_resources = lambda: resources
+    backend.books = {
+        sk.GOOGLE_SHEET_NAME: FakeSpreadsheet("users", [FakeWorksheet(backend, "sheet1", 0, users)]),
+        sk.GOOGLE_DATABASE_SHEET_NAME: FakeSpreadsheet("database", [
+            FakeWorksheet(backend, sk.GOOGLE_CUSTOMERS_SHEET_NAME, 1, customers),
+            FakeWorksheet(backend, sk.GOOGLE_TREATMENTS_SHEET_NAME, 2, treatments),
+        ]),
+    }
+
+    # 前のサイズの状態 (キャッシュ・ローカルのレプリカやインデックス) を捨てる
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    shutil.rmtree(sk.LOCAL_DATA_DIR, ignore_errors=True)
+    os.makedirs(sk.LOCAL_DATA_DIR, exist_ok=True)
+
+    results = []
+    repeat = args.repeat
+
+    def cold_sync(i):
+        sk.get_replica().invalidate()
+        sk.get_snapshot_cache().invalidate()
+
+    results.append(measure(backend, size, "load_customers (全件同期)", lambda i: not sk.load_customers().empty,
+                           max(1, repeat // 10), setup=cold_sync))
+    results.append(measure(backend, size, "load_customers (レプリカから)", lambda i: not sk.load_customers().empty,
+                           repeat, setup=lambda i: sk.get_snapshot_cache().invalidate()))
+    results.append(measure(backend, size, "load_customers (キャッシュ)", lambda i: not sk.load_customers().empty,
+                           repeat))
+    results.append(measure(backend, size, "load_treatments_with_furigana (レプリカから)",
+                           lambda i: not sk.load_treatments_with_furigana().empty,
+                           repeat, setup=lambda i: sk.get_snapshot_cache().invalidate()))
+
+    df_customers = sk.load_customers()
+    df_treatments = sk.load_treatments_with_furigana()
+    queries = [customers[rng.randrange(1, len(customers))][1][:rng.randrange(1, 4)] for _ in range(repeat)]
+    results.append(measure(backend, size, "顧客のタイプアヘッド検索",
+                           lambda i: sk.search_customers(df_customers, queries[i], limit=sk.CUSTOMER_SUGGESTION_LIMIT,
+                                                         substring=False),
+                           repeat))
+
+    keyword_sets = [[rng.choice(TREATMENT_NAMES), rng.choice(MEMO_WORDS)] for _ in range(repeat)]
+
+    def treatment_search(i):
+        return df_treatments.iloc[sk.get_treatment_search_index().search(df_treatments, keyword_sets[i])]
+
+    results.append(measure(backend, size, "施術履歴の AND 検索 (タブ2)", treatment_search, repeat))
+
+    # 顔認証: 初回は登録画像のダウンロードと特徴量の計算、2回目以降は照合だけ
+    store = sk.get_face_descriptor_store()
+    user_records = sk.get_user_directory().get()
+    results.append(measure(backend, size, f"顔特徴量の同期 ({args.face_users} 人, 初回)",
+                           lambda i: store.sync([user["FaceID"] for user in user_records.values()]), 1))
+    camera_users = [rng.randrange(args.face_users) for _ in range(repeat)]
+    camera_images = [backend.files[f"face{user:05d}"]["data"] for user in camera_users]
+
+    class CameraImage:
+        def __init__(self, data):
+            self.data = data
+
+        def getvalue(self):
+            return self.data
+
+    # 合成画像には顔がないので、この計測の間だけ「顔が見つからなければ画像の中央を使う」扱いにして
+    # 照合まで進める (顔検出そのものは実行される)。本人のメールアドレスが返らなければエラーとして数える
+    preprocess_face = sk.preprocess_face
+    sk.preprocess_face = lambda gray, require_face=False: preprocess_face(gray, require_face=False)
+    try:
+        results.append(measure(
+            backend, size, f"face_login (authenticate_face, {args.face_users} 人から本人を照合)",
+            lambda i: sk.authenticate_face(CameraImage(camera_images[i])) == f"staff{camera_users[i]}@example.com",
+            repeat))
+    finally:
+        sk.preprocess_face = preprocess_face
+    user_face_ids = tuple((email, user["FaceID"]) for email, user in user_records.items() if user["FaceID"])
+    queries = [sk.compute_face_descriptors(image) for image in camera_images]
+
+    def face_match(i):
+        matcher = sk.get_face_matcher(user_face_ids, store.version)
+        return bool(matcher.match(queries[i], top_k=sk.FACE_MATCH_TOP_K))
+
+    results.append(measure(backend, size, "face_match (FaceMatcher.match)", face_match, repeat))
+
+    # 書き込み: 画面側の待ち時間 (キューに積むまで) をレイテンシ、送信完了までを合計時間とする
+    queue = sk.get_write_queue()
+    new_ids = []
+    results.append(measure(
+        backend, size, "save_treatment",
+        lambda i: new_ids.append(sk.save_treatment(
+            [customers[1 + i % size][0], "カット", "2025-01-01", None, "ベンチマーク"])),
+        repeat, finish=queue.drain))
+    results.append(measure(
+        backend, size, "update_treatment",
+        lambda i: sk.update_treatment(new_ids[i], {"施術メモ": f"更新 {i}"}),
+        repeat, finish=queue.drain))
+    results.append(measure(
+        backend, size, "delete_treatment",
+        lambda i: sk.delete_treatment(new_ids[i]),
+        repeat, finish=queue.drain))
+    results.append(measure(
+        backend, size, "save_customer",
+        lambda i: sk.save_customer([f"新規 顧客{i}", "シンキ コキャク", "080-0000-0000", "", ""]),
+        repeat, finish=queue.drain))
+    return results
+
+
+def print_table(results):
+    rows = [result.as_dict() for result in results]
+    print(f"{'size':>7}  {'scenario':<44} {'ops':>5} {'err':>4} {'429':>4} {'ops/s':>9} {'p50 ms':>9} {'p99 ms':>9}  api calls")
+    for row in rows:
+        calls = " ".join(f"{name}={count}" for name, count in row["api_calls"].items())
+        print(f"{row['size']:>7}  {row['scenario']:<44} {row['ops']:>5} {row['errors']:>4} {row['quota_errors']:>4} "
+              f"{row['ops_per_s'] or 0:>9.1f} {row['p50_ms']:>9.3f} {row['p99_ms']:>9.3f}  {calls}")
+    return rows
+
+
+def load_app(workdir):
+    """偽の secrets.toml を置いた作業ディレクトリで salon_karute を読み込む."""
+    os.makedirs(os.path.join(workdir, ".streamlit"), exist_ok=True)
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(f'local_data_dir = {json.dumps(os.path.join(workdir, "data"))}\n')
+        f.write('replica_full_sync_interval = 86400\n')
+        f.write('[google]\ntype = "service_account"\nclient_email = "benchmark@example.com"\n')
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import streamlit
+    quiet_streamlit_loggers()
+    import salon_karute
+    quiet_streamlit_loggers()
+    return salon_karute
+
+
+def quiet_streamlit_loggers():
+    """Streamlit の外で実行するときの「ScriptRunContext がない」などの警告を抑える."""
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="salon_karute のオフラインベンチマーク (偽の Sheets / Drive を使用)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="顧客数 (複数指定可)")
+    parser.add_argument("--treatments-per-customer", type=int, default=3, help="顧客1人あたりの施術履歴数")
+    parser.add_argument("--face-users", type=int, default=20, help="顔認証の登録ユーザー数")
+    parser.add_argument("--repeat", type=int, default=50, help="シナリオごとの実行回数")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="API 呼び出し1回あたりに入れる遅延 (ミリ秒)")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0, help="API 呼び出しが 429 になる確率 (0〜1)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    json_path = os.path.abspath(args.json) if args.json else None  # 作業ディレクトリを移る前に解決する
+    backend = FakeBackend(args.latency_ms / 1000, args.quota_error_rate, args.seed)
+    workdir = tempfile.mkdtemp(prefix="salon_benchmark_")
+    try:
+        sk = load_app(workdir)
+        results = []
+        for size in args.sizes:
+            print(f"--- 顧客 {size} 人 / 施術履歴 {size * args.treatments_per_customer} 件 ---", file=sys.stderr)
+            results.extend(run_size(sk, backend, size, args))
+        rows = print_table(results)
+        if json_path:
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(rows, f, ensure_ascii=False, indent=2)
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
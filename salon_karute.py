@@ -1,20 +1,96 @@
 import streamlit as st
-import pandas as pd
-import tempfile
-import gspread
-from google.oauth2.credentials import Credentials
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from googleapiclient.http import MediaIoBaseDownload
+import time  # ローディングインジケーター用
+import threading
+import importlib
+from contextlib import contextmanager
+
+# 起動時間レポート: 重いモジュールの import や Google への接続にかかった時間を記録する
+class StartupReport:
+    """コンポーネント (import・接続など) ごとに、プロセスで最初にかかった秒数を記録する."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def record(self, component, seconds):
+        with self.lock:
+            self.timings.setdefault(component, seconds)  # 2回目以降 (キャッシュ済み) は記録しない
+
+    @contextmanager
+    def measure(self, component):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(component, time.perf_counter() - start)
+
+    def mark_first_render(self):
+        """最初の画面表示が終わった時点までの経過時間を記録し、初回だけレポートをログに出す."""
+        component = "初回の画面表示まで (合計)"
+        if component in self.timings:
+            return
+        self.record(component, time.perf_counter() - self.started)
+        print("起動時間レポート:")
+        for name, seconds in self.rows():
+            print(f"  {seconds * 1000:8.1f} ms  {name}")
+
+    def rows(self):
+        with self.lock:
+            return sorted(self.timings.items(), key=lambda item: item[1], reverse=True)
+
+@st.cache_resource  # プロセス内で1つ (スクリプトの再実行をまたいで残す)
+def get_startup_report():
+    return StartupReport()
+
+class LazyModule:
+    """属性に初めてアクセスしたときに import するモジュール (起動時には読み込まない)."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with get_startup_report().measure(f"import {self._name}"):
+                self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+with get_startup_report().measure("import pandas / numpy"):
+    import pandas as pd
+    import numpy as np
+with get_startup_report().measure("import gspread"):
+    import gspread
 import hashlib
+import hmac
 import re
-import cv2
-import numpy as np
 import io
-from googleapiclient import errors  # Google API のエラー処理用
 import json  # 設定ファイル読み込み用
-import time  # ローディングインジケーター用
+import os
+import sqlite3
+import uuid
+import random
+import atexit
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import defaultdict, OrderedDict
+from array import array
+import bisect
+import unicodedata
+import csv
+import functools
+import urllib.parse
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# 使うときまで読み込まないモジュール (OpenCV はカメラ認証、googleapiclient は Drive / Sheets API の呼び出し時だけ)
+cv2 = LazyModule("cv2")
+service_account = LazyModule("google.oauth2.service_account")
+discovery = LazyModule("googleapiclient.discovery")
+googleapiclient_http = LazyModule("googleapiclient.http")
+errors = LazyModule("googleapiclient.errors")  # Google API のエラー処理用
+google_auth_httplib2 = LazyModule("google_auth_httplib2")
+httplib2 = LazyModule("httplib2")
+Image = LazyModule("PIL.Image")
+ImageOps = LazyModule("PIL.ImageOps")
 
 def responsive_layout():
     # デバイスの画面幅を検出
@@ -43,7 +119,8 @@ def load_config():
         return None
 
 # 設定を読み込む
-config = load_config()
+with get_startup_report().measure("設定の読み込み (secrets.toml)"):
+    config = load_config()
 
 # 設定ファイルが存在しない場合、プログラムを終了
 if config is None:
@@ -56,6 +133,13 @@ GOOGLE_DATABASE_SHEET_NAME = config.get("google_database_sheet_name", "SalonData
 GOOGLE_CUSTOMERS_SHEET_NAME = config.get("google_customers_sheet_name", "Customers")
 GOOGLE_TREATMENTS_SHEET_NAME = config.get("google_treatments_sheet_name", "Treatments")
 GOOGLE_DRIVE_FOLDER_ID = config.get("google_drive_folder_id", "1ykcojVR7RbWBOkTM7DHfxt9_asN2NCSY")
+# ローカルに保持するキャッシュ・インデックス類の保存先
+LOCAL_DATA_DIR = config.get("local_data_dir", ".salon_cache")
+# サイドバーに管理用の診断情報 (起動時間・Google API 呼び出しの集計) を表示するか
+SHOW_DIAGNOSTICS = bool(config.get("show_diagnostics", False))
+# 顔認証: 上位何人まで候補を出すか、本人と認めるスコア (0〜1) のしきい値
+FACE_MATCH_TOP_K = int(config.get("face_match_top_k", 3))
+FACE_MATCH_THRESHOLD = float(config.get("face_match_threshold", 0.05))
 
 if GOOGLE_CREDENTIALS is None:
     st.error("Google API 認証情報が設定されていません。")
@@ -69,23 +153,248 @@ if GOOGLE_DRIVE_FOLDER_ID is None:
 creds_dict = GOOGLE_CREDENTIALS
 # Google Sheets APIに接続するための認証設定
 scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-creds = service_account.Credentials.from_service_account_info(creds_dict, scopes=scope)
 
-# gspreadに認証情報を渡す
-client = gspread.authorize(creds)
+# Google API 呼び出しの計測: HTTP リクエストごとの回数・転送量・所要時間をセッションと再実行ごとに集計する
+API_CALL_LOG_PATH = config.get("api_call_log_path")  # 1呼び出し1行の JSON Lines。未設定なら書き出さない
+API_CALL_MAX_SESSIONS = 200  # 集計を保持するセッション数の上限 (古いものから捨てる)
+BACKGROUND_SESSION = "background"  # 同期・書き込みキュー・アップロードなどスクリプト外のスレッド
+
+def api_label(label):
+    """この中で行われる HTTP リクエストを label (アプリから見た呼び出し名) で記録する."""
+    return get_api_call_recorder().label(label)
+
+def describe_api_request(method, url):
+    """ラベルのない呼び出しの名前を URL から決める (googleapiclient 経由の Drive / Sheets API)."""
+    parsed = urllib.parse.urlparse(url)
+    path = parsed.path
+    if "/drive/" in path:
+        if "alt=media" in parsed.query:
+            return "drive.get_media"
+        if path.startswith("/upload/"):
+            return "drive.create" if method == "POST" else "drive.upload_chunk"
+        return {"GET": "drive.get", "POST": "drive.create", "PATCH": "drive.update", "DELETE": "drive.delete"}.get(
+            method, f"drive.{method.lower()}")
+    if path.endswith(":batchUpdate"):
+        return "sheets.values.batchUpdate" if "/values" in path else "sheets.batchUpdate"
+    if "/values" in path:
+        return f"sheets.values.{method.lower()}"
+    return f"sheets.{method.lower()}"
+
+class ApiCallRecorder:
+    """Google API の HTTP リクエストの回数・転送量 (送受信バイト)・所要時間・エラー数を集計する.
+
+    スクリプトの実行中の呼び出しはそのセッションの「直近の再実行」と「セッション累計」に、
+    スクリプト外のスレッドの呼び出しは BACKGROUND_SESSION に加算する。
+    """
 
-# スプレッドシートにアクセス
-spreadsheet = client.open(GOOGLE_SHEET_NAME)  # スプレッドシート名
+    def __init__(self, log_path=None):
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()  # セッション ID → {"rerun": 回数, "current": 集計, "total": 集計}
+        self.log_path = log_path
+        # スレッドごとの呼び出し名。再実行のたびにスクリプトのモジュールは作り直されるので、
+        # モジュールの変数ではなく共有するこのオブジェクトに持つ
+        self.labels = threading.local()
+
+    @contextmanager
+    def label(self, label):
+        outer = self.current_label()
+        self.labels.value = outer or label  # 入れ子のときは外側 (アプリが呼んだメソッド) の名前を使う
+        try:
+            yield
+        finally:
+            self.labels.value = outer
+
+    def current_label(self):
+        return getattr(self.labels, "value", None)
+
+    def _session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = {"rerun": 0, "current": {}, "total": {}}
+            while len(self.sessions) > API_CALL_MAX_SESSIONS:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(session_id)
+        return session
+
+    def begin_rerun(self):
+        """スクリプトの再実行の始めに呼ぶ (直近の再実行の集計をリセットする)."""
+        ctx = get_script_run_ctx(suppress_warning=True)
+        if ctx is None:
+            return
+        with self.lock:
+            session = self._session(ctx.session_id)
+            session["rerun"] += 1
+            session["current"] = {}
+
+    def record(self, label, seconds, sent, received, status):
+        ctx = get_script_run_ctx(suppress_warning=True)
+        session_id = ctx.session_id if ctx else BACKGROUND_SESSION
+        with self.lock:
+            session = self._session(session_id)
+            for bucket in (session["current"], session["total"]):
+                stats = bucket.setdefault(label, {"calls": 0, "bytes": 0, "seconds": 0.0, "errors": 0})
+                stats["calls"] += 1
+                stats["bytes"] += sent + received
+                stats["seconds"] += seconds
+                stats["errors"] += status is None or status >= 400
+            rerun = session["rerun"]
+            if self.log_path:
+                entry = {"time": time.time(), "session": session_id, "rerun": rerun, "call": label, "status": status,
+                         "bytes_sent": sent, "bytes_received": received, "ms": round(seconds * 1000, 1)}
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def summary(self, session_id, scope):
+        """集計を [(呼び出し, 回数, バイト, 秒, エラー)] で返す。scope は "current" か "total"."""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            stats = dict(session[scope]) if session else {}
+        return sorted(((label, s["calls"], s["bytes"], s["seconds"], s["errors"]) for label, s in stats.items()),
+                      key=lambda row: row[1], reverse=True)
+
+@st.cache_resource  # プロセス内で共有する
+def get_api_call_recorder():
+    return ApiCallRecorder(API_CALL_LOG_PATH)
+
+class InstrumentedHttp:
+    """googleapiclient に渡す httplib2 の Http を包み、リクエストごとに計測する."""
+
+    def __init__(self, http):
+        self._http = http
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        start = time.perf_counter()
+        status, received = None, 0
+        try:
+            response, content = self._http.request(uri, method, body, headers, *args, **kwargs)
+            status, received = response.status, len(content or b"")
+            return response, content
+        finally:
+            recorder = get_api_call_recorder()
+            label = recorder.current_label() or describe_api_request(method, uri)
+            sent = len(body) if isinstance(body, (bytes, str)) else 0
+            recorder.record(label, time.perf_counter() - start, sent, received, status)
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+def instrument_requests_session(session):
+    """gspread が使う requests のセッションの request を包み、リクエストごとに計測する."""
+    request = session.request
+
+    @functools.wraps(request)
+    def instrumented(method, url, *args, **kwargs):
+        start = time.perf_counter()
+        status, received = None, 0
+        try:
+            response = request(method, url, *args, **kwargs)
+            status, received = response.status_code, len(response.content or b"")
+            return response
+        finally:
+            recorder = get_api_call_recorder()
+            label = recorder.current_label() or describe_api_request(method, url)
+            body = kwargs.get("data") or kwargs.get("json") or b""
+            sent = len(body) if isinstance(body, (bytes, str)) else len(json.dumps(body).encode())
+            recorder.record(label, time.perf_counter() - start, sent, received, status)
+
+    session.request = instrumented
+
+class InstrumentedWorksheet:
+    """ワークシートのメソッド呼び出しに、計測用の呼び出し名 (sheets.<メソッド名> (<シート名>)) を付ける."""
+
+    def __init__(self, worksheet):
+        self._worksheet = worksheet
+
+    def __getattr__(self, name):
+        attr = getattr(self._worksheet, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        label = f"sheets.{name} ({self._worksheet.title})"
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            with api_label(label):
+                return attr(*args, **kwargs)
+        return call
+
+class GoogleResources:
+    """認証済みの Google API クライアントと、開いたスプレッドシート・ワークシートを保持する.
+
+    gspread は requests のセッション (keep-alive の接続プール) を使い回す。
+    googleapiclient の httplib2 はスレッドセーフではないため、Drive / Sheets の
+    サービスはスレッドごとに1つ作り、そのスレッドの中で接続を使い回す。
+    """
+
+    def __init__(self, credentials_info):
+        with get_startup_report().measure("Google 認証 (gspread)"):
+            self.credentials = service_account.Credentials.from_service_account_info(credentials_info, scopes=scope)
+            # gspreadに認証情報を渡す
+            self.client = gspread.authorize(self.credentials)
+        instrument_requests_session(self.client.http_client.session)  # API 呼び出しを計測する
+        self.lock = threading.Lock()
+        self.spreadsheets = {}
+        self.worksheets = {}
+        self.local = threading.local()
+
+    def spreadsheet(self, name):
+        """スプレッドシートを開く (2回目以降はメタデータを取得し直さない)."""
+        with self.lock:
+            if name not in self.spreadsheets:
+                with get_startup_report().measure(f"スプレッドシートを開く ({name})"), api_label(f"sheets.open ({name})"):
+                    self.spreadsheets[name] = self.client.open(name)
+            return self.spreadsheets[name]
+
+    def worksheet(self, spreadsheet_name, worksheet_name=None):
+        """ワークシートを開く。worksheet_name が None なら最初のシート (sheet1)."""
+        key = (spreadsheet_name, worksheet_name)
+        with self.lock:
+            if key in self.worksheets:
+                return self.worksheets[key]
+        spreadsheet = self.spreadsheet(spreadsheet_name)
+        with api_label(f"sheets.worksheet ({spreadsheet_name})"):
+            sheet = spreadsheet.sheet1 if worksheet_name is None else spreadsheet.worksheet(worksheet_name)
+        sheet = InstrumentedWorksheet(sheet)  # メソッド名で API 呼び出しを記録する
+        with self.lock:
+            self.worksheets[key] = sheet
+        return sheet
+
+    def service(self, api, version):
+        """Drive / Sheets の API サービス (スレッドごとにキャッシュ)."""
+        services = getattr(self.local, "services", None)
+        if services is None:
+            services = self.local.services = {}
+        if (api, version) not in services:
+            http = InstrumentedHttp(google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=60)))
+            with get_startup_report().measure(f"{api} API サービスの作成"):
+                services[(api, version)] = discovery.build(api, version, http=http, cache_discovery=False)
+        return services[(api, version)]
+
+@st.cache_resource(max_entries=1)  # プロセス内で1つだけ保持 (認証情報が変われば作り直す)
+def _google_resources(credentials_fingerprint):
+    return GoogleResources(creds_dict)
+
+def get_google_resources():
+    # 認証情報の内容をキーにして、secrets の差し替え時は自動的に作り直す
+    fingerprint = hashlib.sha256(json.dumps(dict(creds_dict), sort_keys=True).encode()).hexdigest()
+    return _google_resources(fingerprint)
+
+def reset_google_resources():
+    """キャッシュ済みのクライアント・開いたシートを破棄する (認証情報のローテーション時など)."""
+    _google_resources.clear()
+
+def open_spreadsheet(name):
+    return get_google_resources().spreadsheet(name)
+
+def open_worksheet(spreadsheet_name, worksheet_name=None):
+    return get_google_resources().worksheet(spreadsheet_name, worksheet_name)
 
 # パスワードのハッシュ
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
-# Google Drive API サービスを構築
+# Google Drive API サービスを取得 (プロセス内で使い回す)
 def authenticate_google_drive():
-    credentials = service_account.Credentials.from_service_account_info(creds_dict, scopes=scope)
-    service = build('drive', 'v3', credentials=credentials)
-    return service
+    return get_google_resources().service('drive', 'v3')
 
 # Google Drive API: ファイル名とリンクを効率的に取得 (フィールドマスクを使用)
 def get_file_name_and_link(file_id):
@@ -103,127 +412,1459 @@ def get_file_name_and_link(file_id):
 
 # 顔認証
 # Google Drive から画像をダウンロード
+def drive_cache_key(metadata):
+    """ダウンロードキャッシュのキー。内容の MD5 があれば内容そのもので引く (同じ内容なら共有)."""
+    if metadata.get("md5Checksum"):
+        return f"md5_{metadata['md5Checksum']}"
+    # MD5 のないファイルは ID と更新日時で引く (更新されれば別のキーになる)
+    return f"file_{metadata['id']}_{re.sub(r'[^0-9A-Za-z]', '', metadata.get('modifiedTime', ''))}"
+
 def download_image_from_drive(file_id):
-    """Google Drive から画像をダウンロード (フィールドマスクを使用)."""
+    """Google Drive から画像をダウンロード (フィールドマスクを使用).
+
+    メタデータ (md5Checksum / modifiedTime) だけを取得し、同じ内容がローカルの
+    キャッシュにあればそれを返す。なければ本体をダウンロードし、MD5 を確かめてから保存する。
+    """
     try:
         service = authenticate_google_drive()
+        metadata = service.files().get(fileId=file_id, fields="id,md5Checksum,modifiedTime").execute()
+        cache = get_drive_cache()
+        key = drive_cache_key(metadata)
+        data = cache.get(key)
+        if data is not None:
+            return io.BytesIO(data)
+
         request = service.files().get_media(fileId=file_id)
         file = io.BytesIO()
-        downloader = MediaIoBaseDownload(file, request)
+        downloader = googleapiclient_http.MediaIoBaseDownload(file, request)
         done = False
         while not done:
             _, done = downloader.next_chunk()
+        data = file.getvalue()
+        if not metadata.get("md5Checksum") or hashlib.md5(data).hexdigest() == metadata["md5Checksum"]:
+            cache.put(key, data)
+        else:
+            print(f"ダウンロードした内容の MD5 が一致しません: {file_id}")  # 壊れた内容はキャッシュしない
         file.seek(0)
         return file
     except errors.HttpError as error:
         print(f"An error occurred: {error}")
         return None
 
-# 顔認識（OpenCV）を使って認証
-def face_recognition(uploaded_image, registered_image):
-    # 画像を OpenCV 形式に変換
-    img1 = cv2.imdecode(np.frombuffer(uploaded_image.read(), np.uint8), cv2.IMREAD_COLOR)
-    img2 = cv2.imdecode(np.frombuffer(registered_image.read(), np.uint8), cv2.IMREAD_COLOR)
+# 顔画像の前処理: 顔を検出して切り出し、固定サイズに正規化してから特徴量を計算
+FACE_DETECT_MAX_SIDE = 640  # 顔検出前に縮小する長辺のピクセル数
+FACE_SIZE = 200  # 切り出した顔を正規化するサイズ (正方形)
+FACE_ORB_FEATURES = 300  # 1枚あたりの ORB 特徴点数の上限
+FACE_PIPELINE_VERSION = 2  # 前処理を変えたら増やす (保存済み特徴量を作り直す)
+
+@st.cache_resource  # 検出器と ORB はプロセス内で使い回す
+def get_face_pipeline():
+    detector = None
+    with get_startup_report().measure("顔検出モデルの読み込み"):
+        if hasattr(cv2, "CascadeClassifier"):  # OpenCV 4 系に同梱のカスケード分類器
+            detector = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+            if detector.empty():
+                detector = None
+    if detector is None:
+        print("顔検出器を読み込めませんでした。画像の中央を顔領域として扱います。")
+    orb = cv2.ORB_create(nfeatures=FACE_ORB_FEATURES)
+    return detector, orb, threading.Lock()
+
+def preprocess_face(gray, require_face=False):
+    """グレースケール画像から最も大きい顔を切り出し、FACE_SIZE 四方に正規化する.
+
+    顔が見つからない場合、require_face なら None、そうでなければ画像の中央を使う。
+    検出器が使えない環境では常に画像の中央を使う。
+    """
+    detector, _, _ = get_face_pipeline()
+
+    # 検出はフル解像度ではなく縮小画像で行う
+    scale = FACE_DETECT_MAX_SIDE / max(gray.shape[:2])
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    faces = ()
+    if detector is not None:
+        faces = detector.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(60, 60))
+    if len(faces) > 0:
+        x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+        # 輪郭の特徴点も拾えるよう少し余白を付けて切り出す
+        margin = int(0.1 * w)
+        x0, y0 = max(x - margin, 0), max(y - margin, 0)
+        face = gray[y0:y + h + margin, x0:x + w + margin]
+    elif require_face and detector is not None:
+        return None
+    else:
+        height, width = gray.shape[:2]
+        side = min(height, width)
+        top, left = (height - side) // 2, (width - side) // 2
+        face = gray[top:top + side, left:left + side]
+
+    face = cv2.resize(face, (FACE_SIZE, FACE_SIZE), interpolation=cv2.INTER_AREA)
+    return cv2.equalizeHist(face)  # 照明の差を吸収
+
+def compute_face_descriptors(image_bytes, require_face=False):
+    """画像のバイト列から顔領域の ORB 特徴量 (N x 32 の uint8 配列) を計算。特徴点がなければ None."""
+    # 画像を OpenCV 形式 (グレースケール) に変換
+    gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
 
-    # グレースケール変換
-    gray1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-    gray2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
+    face = preprocess_face(gray, require_face=require_face)
+    if face is None:
+        return None
 
     # ORB (Oriented FAST and Rotated BRIEF) を使った特徴点検出
-    orb = cv2.ORB_create()
-    kp1, des1 = orb.detectAndCompute(gray1, None)
-    kp2, des2 = orb.detectAndCompute(gray2, None)
+    _, orb, orb_lock = get_face_pipeline()
+    with orb_lock:
+        _, descriptors = orb.detectAndCompute(face, None)
+    return descriptors
 
-    # 特徴点のマッチング
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-    matches = bf.match(des1, des2)
+class FaceDescriptorStore:
+    """登録顔画像 (FaceID) ごとの ORB 特徴量をローカルの npz ファイルに保持する.
 
-    # 類似度（マッチング数）を計算
-    similarity = len(matches)
+    ログインのたびに登録画像をダウンロードして特徴量を計算し直さないよう、
+    FaceID が新しく登録・変更されたものだけを計算して追記する。
+    """
 
-    return similarity
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.descriptors = self._load()
+        self.version = 0  # 内容が変わるたびに増やす (照合インデックスの再構築判定用)
+
+    def _load(self):
+        """npz ファイルから {FaceID: 特徴量} を読み込む (ファイルがなければ空)."""
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if int(data["pipeline_version"]) != FACE_PIPELINE_VERSION:
+                    return {}  # 前処理が変わったので全件計算し直す
+                face_ids = data["face_ids"].tolist()
+                counts = data["counts"].tolist()
+                packed = data["descriptors"]
+        except Exception as e:
+            print(f"顔特徴量ストアの読み込みに失敗しました。再構築します: {e}")
+            return {}
+
+        descriptors = {}
+        offset = 0
+        for face_id, count in zip(face_ids, counts):
+            descriptors[face_id] = packed[offset:offset + count] if count else None
+            offset += count
+        return descriptors
+
+    def _save(self):
+        """全 FaceID の特徴量を1つの配列に詰めて保存する (一時ファイル経由で置き換え)."""
+        face_ids = list(self.descriptors)
+        arrays = [self.descriptors[face_id] for face_id in face_ids]
+        counts = [0 if a is None else len(a) for a in arrays]
+        non_empty = [a for a in arrays if a is not None]
+        packed = np.concatenate(non_empty) if non_empty else np.empty((0, 32), dtype=np.uint8)
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = self.path + ".tmp.npz"
+        np.savez(temp_path, pipeline_version=FACE_PIPELINE_VERSION, face_ids=np.array(face_ids, dtype=str),
+                 counts=np.array(counts, dtype=np.int64), descriptors=packed)
+        os.replace(temp_path, self.path)
+
+    def get(self, face_id):
+        return self.descriptors.get(face_id)
+
+    def sync(self, face_ids):
+        """ユーザーシートの FaceID 一覧に合わせてストアを更新する.
+
+        未登録の FaceID だけ画像をダウンロードして特徴量を計算し、
+        シートから消えた FaceID は削除する。変更があった場合のみ保存する。
+        """
+        face_ids = {face_id for face_id in face_ids if face_id}
+        with self.lock:
+            changed = False
+            for face_id in face_ids - self.descriptors.keys():
+                registered_image = download_image_from_drive(face_id)
+                if registered_image is None:
+                    st.error(f"登録画像 ({face_id}) のダウンロードに失敗しました。")
+                    continue  # 次回のログイン時に再試行
+                self.descriptors[face_id] = compute_face_descriptors(registered_image.read())
+                changed = True
 
- # スプレッドシートからユーザーの登録画像IDを取得
-def get_registered_image_id(user_email):
-    # Google Sheets APIの認証（事前にシートをGoogle Drive APIと連携）
+            for face_id in self.descriptors.keys() - face_ids:
+                del self.descriptors[face_id]
+                changed = True
 
-    spreadsheet = client.open(GOOGLE_SHEET_NAME)  # スプレッドシート名
-    SHEET_ID = spreadsheet.id # スプレッドシートのIDを取得
-    sheet = spreadsheet.worksheet("sheet1")  # シート名 "Users" を指定
-    # RANGE = "Users!A2:B"  # A列にメールアドレス、B列に画像のDrive File ID
+            if changed:
+                self._save()
+                self.version += 1
+        return changed
 
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    credentials = service_account.Credentials.from_service_account_info(creds_dict, scopes=scope)
-    # スプレッドシートの全データを取得
-    values = sheet.get_all_values()
+@st.cache_resource  # プロセス内で1つのストアを共有
+def get_face_descriptor_store():
+    return FaceDescriptorStore(os.path.join(LOCAL_DATA_DIR, "face_descriptors.npz"))
 
-    # ユーザーの顔画像IDを探す
-    for row in values:
-        if row[0] == user_email:  # メールアドレスが一致する場合
-            return row[1]  # 画像ファイルIDを返す
+# 顔認識（OpenCV）: 登録ユーザー全員を1つの LSH インデックスで照合
+FLANN_INDEX_LSH = 6
 
-    return None  # 該当するデータがない場合は None を返す
+class FaceMatcher:
+    """全登録ユーザーの ORB 特徴量を1つの FLANN-LSH インデックスにまとめた 1 対多照合器.
 
+    撮影画像の各特徴量について近傍2件を引き、比率テストを通ったものを
+    そのユーザーへの1票として集計する。スコアは撮影画像の特徴量数で正規化 (0〜1)。
+    """
+
+    def __init__(self, entries, ratio=0.75):
+        """entries: (Email, 特徴量) のリスト。特徴量のないユーザーは除外する."""
+        self.ratio = ratio
+        self.emails = []
+        descriptors = []
+        for email, user_descriptors in entries:
+            if user_descriptors is None or len(user_descriptors) == 0:
+                continue
+            self.emails.append(email)
+            descriptors.append(user_descriptors)
+
+        self.matcher = cv2.FlannBasedMatcher(
+            dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1),
+            dict(checks=50),
+        )
+        if descriptors:
+            self.matcher.add(descriptors)
+            self.matcher.train()
+
+    def match(self, query_descriptors, top_k=3):
+        """上位 top_k 人の候補を [(Email, スコア), ...] (スコア降順) で返す."""
+        if not self.emails or query_descriptors is None or len(query_descriptors) == 0:
+            return []
+
+        votes = np.zeros(len(self.emails))
+        for pair in self.matcher.knnMatch(query_descriptors, k=2):
+            if not pair:
+                continue
+            # 比率テスト: 2番目の候補より十分近いものだけを採用
+            if len(pair) == 1 or pair[0].distance < self.ratio * pair[1].distance:
+                votes[pair[0].imgIdx] += 1
+
+        scores = votes / len(query_descriptors)
+        ranked = np.argsort(-scores, kind="stable")[:top_k]
+        return [(self.emails[i], float(scores[i])) for i in ranked if scores[i] > 0]
+
+@st.cache_resource(max_entries=1)  # ユーザー構成か特徴量ストアが変わったときだけ再構築
+def get_face_matcher(user_face_ids, store_version):
+    """user_face_ids: (Email, FaceID) のタプル。store_version はキャッシュキーとしてのみ使用."""
+    store = get_face_descriptor_store()
+    return FaceMatcher([(email, store.get(face_id)) for email, face_id in user_face_ids])
+
+ # ユーザー名簿からユーザーの登録画像IDを取得
+def get_registered_image_id(user_email):
+    # ユーザー名簿 (メールアドレス → FaceID) から引く
+    user = get_user_directory().lookup(user_email)
+    return user["FaceID"] if user and user["FaceID"] else None  # 該当するデータがない場合は None を返す
 
-# スプレッドシートからユーザーのメールアドレスを取得
+
+# ユーザー名簿からユーザーのメールアドレスを取得
 def get_user_email_from_image_id(image_id):
-    sheet = client.open(GOOGLE_SHEET_NAME).sheet1
-    data = sheet.get_all_values()
-    for row in data[1:]:  # ヘッダー行をスキップ
-        if row[1] == image_id:  # 画像IDが一致する場合
-            return row[0]  # メールアドレスを返す
+    for email, user in get_user_directory().get().items():
+        if user["FaceID"] == image_id:  # 画像IDが一致する場合
+            return email  # メールアドレスを返す
     return None  # 該当するデータがない場合は None を返す
 
-def upload_to_drive(file):
+# 施術写真のサムネイルと、Drive からダウンロードした画像のローカルキャッシュ
+IMAGE_CACHE_DIR = os.path.join(LOCAL_DATA_DIR, "images")
+IMAGE_CACHE_MAX_BYTES = int(config.get("image_cache_max_mb", 200)) * 1024 * 1024  # キャッシュ全体の上限
+DRIVE_CACHE_DIR = os.path.join(LOCAL_DATA_DIR, "drive")
+DRIVE_CACHE_MAX_BYTES = int(config.get("drive_cache_max_mb", 500)) * 1024 * 1024  # Drive からダウンロードした原本の上限
+THUMBNAIL_WIDTH = int(config.get("thumbnail_width", 320))  # サムネイルの幅 (ピクセル)
+THUMBNAIL_QUALITY = 80  # サムネイルの JPEG 画質
+THUMBNAIL_RETRY_INTERVAL = int(config.get("thumbnail_retry_interval", 300))  # 取得に失敗した写真はこの秒数の間は取り直さない
+
+class DiskLRUCache:
+    """ディレクトリにファイルとして保存する、合計サイズの上限付き LRU キャッシュ.
+
+    アクセス順はメモリ上の OrderedDict で持ち、起動時はファイルの更新日時から復元する。
+    上限を超えたら最も長く使われていないファイルから消す。キーはそのままファイル名になる。
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # キー → サイズ (古い順)
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)  # 書き込み途中で終了したファイル
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+        self.total = sum(self.entries.values())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """キャッシュ済みなら内容 (bytes) を返し、最近使ったものとして記録する."""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # 再起動後もアクセス順を復元できるように
+            return data
+        except OSError:
+            self.discard(key)
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)  # 読み込み中の他スレッドに書きかけを見せない
+        with self.lock:
+            self.total += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                old_key, size = self.entries.popitem(last=False)
+                self.total -= size
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def discard(self, key):
+        with self.lock:
+            self.total -= self.entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+@st.cache_resource  # プロセス内で共有する (全セッション共通のキャッシュ)
+def get_image_cache():
+    return DiskLRUCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+@st.cache_resource  # プロセス内で共有する (全セッション共通のキャッシュ)
+def get_drive_cache():
+    return DiskLRUCache(DRIVE_CACHE_DIR, DRIVE_CACHE_MAX_BYTES)
+
+def make_thumbnail(image_bytes, width=THUMBNAIL_WIDTH):
+    """画像を幅 width 以下に縮小した JPEG (bytes) を返す。画像として読めなければ None."""
     try:
-        service = authenticate_google_drive()
-        # folder_id = st.secrets["google_drive"]["folder_id"]
-        folder_id = GOOGLE_DRIVE_FOLDER_ID
-        file_metadata = {
-            'name': file.name,
-            'parents': [folder_id]
-        }
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(file.read())
-            temp_file_path = temp_file.name
-
-        media = MediaFileUpload(temp_file_path, mimetype='application/octet-stream')  # 画像のMIMEタイプを確認
-        uploaded_file = service.files().create(body=file_metadata, media_body=media, fields='id,webViewLink').execute() # フィールドマスクを追加
-        file_url = f"https://drive.google.com/file/d/{uploaded_file.get('id')}/view?usp=sharing"
-        return file_url
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            image = ImageOps.exif_transpose(image)  # スマホ写真の回転情報を反映
+            image.thumbnail((width, width * 4))
+            output = io.BytesIO()
+            image.convert("RGB").save(output, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+            return output.getvalue()
     except Exception as e:
-        st.error(f"❌ 画像のアップロードに失敗しました: {e}")
+        print(f"サムネイルの作成に失敗しました: {e}")
+        return None
+
+def drive_file_id(file_url):
+    """Drive の共有 URL (…/file/d/<ID>/view や ?id=<ID>) からファイル ID を取り出す."""
+    match = re.search(r"/d/([\w-]+)|[?&]id=([\w-]+)", str(file_url))
+    return (match.group(1) or match.group(2)) if match else None
+
+def thumbnail_cache_key(file_id, width=THUMBNAIL_WIDTH):
+    return f"thumb_{file_id}_{width}.jpg"
+
+@st.cache_resource  # プロセス内で共有する {ファイル ID: 取得に失敗した時刻}
+def get_thumbnail_failures():
+    return {}
+
+def get_treatment_thumbnail(file_url, fetch=True):
+    """施術写真のサムネイル (bytes) をローカルのキャッシュから返す.
+
+    キャッシュになければ、アップロード時に作ったサムネイル (元画像の appProperties に
+    ID を記録) を Drive から取得する。サムネイルのない古い写真は元画像から作る。
+    fetch=False ならローカルのキャッシュだけを見る。取得に失敗した写真は
+    THUMBNAIL_RETRY_INTERVAL 秒の間は Drive に問い合わせずに None を返す。
+    """
+    file_id = drive_file_id(file_url)
+    if not file_id:
         return None
+    cache = get_image_cache()
+    key = thumbnail_cache_key(file_id)
+    data = cache.get(key)
+    if data is not None or not fetch:
+        return data
+    failures = get_thumbnail_failures()
+    if time.time() - failures.get(file_id, 0) < THUMBNAIL_RETRY_INTERVAL:
+        return None
+    try:
+        service = authenticate_google_drive()
+        metadata = service.files().get(fileId=file_id, fields="appProperties").execute()
+    except errors.HttpError as error:
+        print(f"An error occurred: {error}")
+        failures[file_id] = time.time()
+        return None
+    thumbnail_id = metadata.get("appProperties", {}).get(f"thumbnail_{THUMBNAIL_WIDTH}")
+    source = download_image_from_drive(thumbnail_id or file_id)
+    data = None
+    if source is not None:
+        data = source.getvalue() if thumbnail_id else make_thumbnail(source.getvalue())
+    if data:
+        cache.put(key, data)
+        failures.pop(file_id, None)
+    else:
+        failures[file_id] = time.time()
+    return data
+
+# 施術写真のアップロード: メモリ上のバッファから分割・再開可能なアップロードをバックグラウンドで行う
+UPLOAD_CHUNK_SIZE = int(config.get("upload_chunk_mb", 1)) * 1024 * 1024  # 256KB の倍数にする
+UPLOAD_WORKERS = int(config.get("upload_workers", 2))
+
+def upload_to_drive(data, name, mimetype=None, on_progress=None):
+    """画像 (bytes) をサムネイルとともに Drive にアップロードし、共有 URL を返す.
+
+    一時ファイルは作らず、メモリ上のバッファから UPLOAD_CHUNK_SIZE ずつ再開可能な
+    アップロードで送る。一時的なエラーはライブラリが途中のチャンクから再試行する。
+    on_progress には 0〜1 の進捗が渡される。失敗時は例外を送出する。
+    """
+    service = authenticate_google_drive()
+    # folder_id = st.secrets["google_drive"]["folder_id"]
+    folder_id = GOOGLE_DRIVE_FOLDER_ID
+    file_metadata = {
+        'name': name,
+        'parents': [folder_id]
+    }
+
+    # サムネイルを先にアップロードし、その ID を元画像の appProperties に記録する
+    thumbnail = make_thumbnail(data)
+    if thumbnail:
+        thumbnail_metadata = {'name': f"thumb_{THUMBNAIL_WIDTH}_{os.path.splitext(name)[0]}.jpg", 'parents': [folder_id]}
+        thumbnail_media = googleapiclient_http.MediaIoBaseUpload(io.BytesIO(thumbnail), mimetype='image/jpeg')
+        uploaded_thumbnail = service.files().create(body=thumbnail_metadata, media_body=thumbnail_media, fields='id').execute()
+        file_metadata['appProperties'] = {f"thumbnail_{THUMBNAIL_WIDTH}": uploaded_thumbnail.get('id')}
+
+    media = googleapiclient_http.MediaIoBaseUpload(io.BytesIO(data), mimetype=mimetype or 'application/octet-stream',
+                                                   chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+    request = service.files().create(body=file_metadata, media_body=media, fields='id') # フィールドマスクを追加
+    uploaded_file = None
+    while uploaded_file is None:
+        status, uploaded_file = request.next_chunk(num_retries=WRITE_MAX_RETRIES)
+        if status and on_progress:
+            on_progress(status.progress())
+    if on_progress:
+        on_progress(1.0)
+    if thumbnail:
+        get_image_cache().put(thumbnail_cache_key(uploaded_file.get('id')), thumbnail)  # 表示時に Drive から取り直さない
+    return f"https://drive.google.com/file/d/{uploaded_file.get('id')}/view?usp=sharing"
+
+class PhotoUpload:
+    """バックグラウンドで進む写真アップロード1件の状態 (セッションから進捗・結果を参照する)."""
+
+    def __init__(self, label):
+        self.label = label
+        self.progress = 0.0
+        self.future = None
+
+@st.cache_resource  # プロセスにつき1つのワーカープール
+def get_upload_pool():
+    pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="drive-upload")
+    atexit.register(pool.shutdown, wait=True)  # 終了時は送信中のアップロードを待つ
+    return pool
+
+def _upload_treatment_photo(upload, data, name, mimetype, treatment_id):
+    """ワーカースレッドで実行: 写真をアップロードし、施術履歴の写真列に URL を書き込む."""
+    def on_progress(progress):
+        upload.progress = progress
+    file_url = upload_to_drive(data, name, mimetype, on_progress)
+    future = write_record("treatments", treatment_id, {"写真": file_url})
+    if future is None:
+        raise LookupError("写真を登録する施術履歴が見つかりませんでした。")
+    future.result()  # シートへの反映の失敗もアップロードの失敗として報告する
+    return file_url
+
+def start_photo_upload(photo, treatment_id, label):
+    """写真のアップロードをバックグラウンドで開始し、完了したら施術履歴の行に URL を反映する."""
+    upload = PhotoUpload(label)
+    upload.future = get_upload_pool().submit(
+        _upload_treatment_photo, upload, photo.getvalue(), photo.name, getattr(photo, "type", None), treatment_id
+    )
+    st.session_state.setdefault("photo_uploads", []).append(upload)
+    return upload
+
+@st.fragment(run_every=1)  # アップロード中だけ1秒ごとに進捗を更新する
+def _show_upload_progress():
+    uploads = st.session_state.get("photo_uploads", [])
+    for upload in uploads:
+        if not upload.future.done():
+            st.progress(upload.progress, text=f"📤 {upload.label}の写真をアップロード中...")
+    if all(upload.future.done() for upload in uploads):
+        st.rerun()  # 完了したら画面全体を更新して結果を表示する
+
+def show_upload_status():
+    """セッションで開始した写真アップロードの進捗・完了・失敗を表示する."""
+    uploads = st.session_state.get("photo_uploads", [])
+    pending = [upload for upload in uploads if not upload.future.done()]
+    for upload in uploads:
+        if upload.future.done():
+            if upload.future.exception() is not None:
+                st.error(f"❌ {upload.label}の写真のアップロードに失敗しました: {upload.future.exception()}")
+            else:
+                st.success(f"✅ {upload.label}の写真をアップロードしました")
+    st.session_state["photo_uploads"] = pending
+    if pending:
+        _show_upload_progress()
 
 def convert_to_katakana(text):
     """ ひらがなをカタカナに変換 """
-    hira_to_kata = str.maketrans(
-        "ぁあぃいぅうぇえぉおかがきぎくぐけげこごさざしじすずせぜそぞただちぢつづてでとどなにぬねのはばぱ히비피ふぶぷへべぺほぼぽまみむめもゃやゅゆょよらりるれろゎわゐゑをん",
-        "ァアィイゥウェエォオカガキギクグケゲコゴサザシジスズセゼソゾタダチヂツヅテデトドナニヌネノハバ파히비피フブプヘベペホボポマミムメモャヤュユョヨラリルレロヮワヰヱヲン"
-    )
-    return text.translate(hira_to_kata)
+    # ぁ(U+3041)〜ゖ(U+3096) は 0x60 足すと対応するカタカナになる
+    return "".join(chr(ord(c) + 0x60) if "ぁ" <= c <= "ゖ" else c for c in text)
 
-@st.cache_data(ttl=60)  # 60秒間キャッシュ
-def load_treatments_with_furigana():
-    """施術履歴に顧客情報のフリガナを追加"""
-    try:
-        with st.spinner("施術履歴を読み込み中..."): # ローディングインジケーター
-            sheet_treatments = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_TREATMENTS_SHEET_NAME)
-            data_treatments = sheet_treatments.get_all_records()
-            df_treatments = pd.DataFrame(data_treatments)
+# 検索用の正規化で取り除く文字 (空白と長音・ダッシュ類)
+SEARCH_KEY_FOLDED = re.compile(r"[\sー‐―－\-~〜]")
+
+def normalize_search_key(text):
+    """顧客検索用の正規化キー.
+
+    NFKC (半角カナ→全角、全角英数→半角)、小文字化、ひらがな→カタカナの後、
+    空白と長音記号を取り除く。「やまだ はなこ」「ﾔﾏﾀﾞﾊﾅｺ」「ヤマダ　ハナコ」は同じキーになる。
+    """
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    return SEARCH_KEY_FOLDED.sub("", convert_to_katakana(text))
+
+# ローカル SQLite レプリカ: 顧客・施術履歴シートの読み取り用コピー
+REPLICA_PATH = os.path.join(LOCAL_DATA_DIR, "replica.sqlite3")
+REPLICA_SYNC_INTERVAL = int(config.get("replica_sync_interval", 60))  # バックグラウンド同期の間隔 (秒)
+# 差分同期していても、この間隔 (秒) ごとに全件を取り直す (シート途中の直接編集への安全策)
+REPLICA_FULL_SYNC_INTERVAL = int(config.get("replica_full_sync_interval", 600))
+REPLICA_SCHEMA_VERSION = 3  # sync_meta などの構造を変えたら増やす (ローカルのレプリカを作り直す)
+# 顧客・施術履歴の各行を識別する主キーの列 (シートの最後の列に追加する)
+ID_COLUMN = "ID"
+# レプリカのテーブル名 → (ワークシート名, インデックスを張る列)
+REPLICA_TABLES = {
+    "customers": (GOOGLE_CUSTOMERS_SHEET_NAME, [ID_COLUMN, "顧客名", "フリガナ", "電話番号"]),
+    "treatments": (GOOGLE_TREATMENTS_SHEET_NAME, [ID_COLUMN, "顧客名", "日付"]),
+}
+
+def new_record_id():
+    """顧客・施術履歴の行に振る ID (12桁の16進数)."""
+    return uuid.uuid4().hex[:12]
+
+def header_checksum(headers):
+    return hashlib.sha256(json.dumps(headers, ensure_ascii=False).encode()).hexdigest()
+
+def _pad_row(row, width):
+    """シートの行 (末尾の空セルが省略される) を列数 width に揃える."""
+    return (list(row) + [""] * width)[:width]
+
+def _quote(identifier):
+    """SQLite の識別子としてクォートする (列名はシートのヘッダーをそのまま使う)."""
+    return '"' + identifier.replace('"', '""') + '"'
+
+class SheetReplica:
+    """顧客・施術履歴シートの内容を保持するローカル SQLite レプリカ.
+
+    各テーブルはシートのヘッダーをそのまま列名とし、_row 列にシート上の行番号
+    (ヘッダーが1行目) を持つ。画面の読み込みはこのレプリカから行い、シートへの
+    書き込みは同じ内容をレプリカにも反映する (ライトスルー)。
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.local_writes = 0  # ライトスルーの回数 (同期中に書き込みがあったかの判定用)
+        self.versions = defaultdict(int)  # テーブルの内容が変わるたびに増やすバージョン (検索インデックスなどの更新判定用)
+        with self.lock, self.conn:
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] != REPLICA_SCHEMA_VERSION:
+                # 古い形式のレプリカは捨てて、次回の同期で全件取り直す
+                for table in ["sync_meta", *REPLICA_TABLES]:
+                    self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+                self.conn.execute(f"PRAGMA user_version = {REPLICA_SCHEMA_VERSION}")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS sync_meta (table_name TEXT PRIMARY KEY, headers TEXT NOT NULL, "
+                "header_checksum TEXT NOT NULL, synced_at REAL NOT NULL, full_synced_at REAL NOT NULL)"
+            )
+
+    def headers(self, table):
+        """テーブルの列名 (シートのヘッダー)。未同期なら None."""
+        with self.lock:
+            row = self.conn.execute("SELECT headers FROM sync_meta WHERE table_name = ?", (table,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def is_synced(self):
+        return all(self.headers(table) is not None for table in REPLICA_TABLES)
+
+    def sync_meta(self, table):
+        """最後の同期の情報 {headers, header_checksum, synced_at, full_synced_at}。未同期なら None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT headers, header_checksum, synced_at, full_synced_at FROM sync_meta WHERE table_name = ?",
+                (table,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {"headers": json.loads(row[0]), "header_checksum": row[1], "synced_at": row[2], "full_synced_at": row[3]}
+
+    def last_row(self, table):
+        """同期済みの最終行のシート上の行番号 (データがなければヘッダーの1)."""
+        with self.lock:
+            return self.conn.execute(f"SELECT COALESCE(MAX(_row), 1) FROM {table}").fetchone()[0]
+
+    def row_values(self, table, sheet_row):
+        """シートの sheet_row 行目に相当する値のリスト (1行目はヘッダー)."""
+        headers = self.headers(table) or []
+        if sheet_row == 1:
+            return headers
+        with self.lock:
+            row = self.conn.execute(f"SELECT * FROM {table} WHERE _row = ?", (sheet_row,)).fetchone()
+        return list(row[1:]) if row else None
+
+    def replace_table(self, table, values, if_unchanged_since=None):
+        """シートの全データ (ヘッダー行 + データ行) でテーブルを置き換える.
+
+        if_unchanged_since に取得開始時の local_writes を渡すと、取得中にライトスルーが
+        あった場合は置き換えずに False を返す (古いデータで書き込みを上書きしないため)。
+        内容が今のテーブルと同じなら同期時刻だけを更新し、バージョンは変えない
+        (定期的な全件同期のたびにスナップショットや検索インデックスを作り直さないため)。
+        """
+        headers = values[0] if values else []
+        rows = [_pad_row(row, len(headers)) for row in values[1:]]
+        columns = "".join(f", {_quote(header)} TEXT" for header in headers)
+        placeholders = ", ".join("?" * (len(headers) + 1))
+
+        with self.lock:
+            if if_unchanged_since is not None and if_unchanged_since != self.local_writes:
+                return False
+            if headers == self.headers(table) and rows == self._rows(table):
+                now = time.time()
+                with self.conn:
+                    self.conn.execute("UPDATE sync_meta SET synced_at = ?, full_synced_at = ? WHERE table_name = ?",
+                                      (now, now, table))
+                return True
+            with self.conn:
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+                self.conn.execute(f"CREATE TABLE {table} (_row INTEGER NOT NULL{columns})")
+                self.conn.executemany(
+                    f"INSERT INTO {table} VALUES ({placeholders})",
+                    [(i, *row) for i, row in enumerate(rows, start=2)],
+                )
+                self.conn.execute(f"CREATE INDEX {table}_row ON {table} (_row)")
+                for i, column in enumerate(REPLICA_TABLES[table][1]):
+                    if column in headers:
+                        self.conn.execute(f"CREATE INDEX {table}_idx{i} ON {table} ({_quote(column)})")
+                now = time.time()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO sync_meta VALUES (?, ?, ?, ?, ?)",
+                    (table, json.dumps(headers, ensure_ascii=False), header_checksum(headers), now, now),
+                )
+            self.versions[table] += 1
+        return True
+
+    def _rows(self, table):
+        """テーブルの全行 (シートの行順、_row 列を除いた値のリスト)."""
+        return [list(row[1:]) for row in self.conn.execute(f"SELECT * FROM {table} ORDER BY _row")]
+
+    def invalidate(self):
+        """同期情報を消して、次の読み込みで全件を取り直させる."""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM sync_meta")
+
+    def find_row(self, table, record_id):
+        """ID からシート上の行番号を引く (ID 列のインデックスを使うので全件は読まない)。なければ None."""
+        if ID_COLUMN not in (self.headers(table) or []):
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT _row FROM {table} WHERE {_quote(ID_COLUMN)} = ?", (record_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def append_synced_rows(self, table, rows, if_unchanged_since=None):
+        """差分同期で取得した新しい行を末尾に追記する (引数の意味は replace_table と同じ)."""
+        headers = self.headers(table)
+        placeholders = ", ".join("?" * (len(headers) + 1))
+        with self.lock:
+            if if_unchanged_since is not None and if_unchanged_since != self.local_writes:
+                return False
+            with self.conn:
+                next_row = self.last_row(table) + 1
+                self.conn.executemany(
+                    f"INSERT INTO {table} VALUES ({placeholders})",
+                    [(i, *_pad_row(row, len(headers))) for i, row in enumerate(rows, start=next_row)],
+                )
+                self.conn.execute("UPDATE sync_meta SET synced_at = ? WHERE table_name = ?", (time.time(), table))
+            if rows:
+                self.versions[table] += 1
+        return True
 
-            # 顧客情報の取得（顧客名とフリガナの対応を取得）
-            sheet_customers = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_CUSTOMERS_SHEET_NAME)
-            data_customers = sheet_customers.get_all_records()
-            df_customers = pd.DataFrame(data_customers)
+    def read_frame(self, table):
+        """テーブルをシートの行順の DataFrame として読み込む (_row 列は含めない)."""
+        headers = self.headers(table)
+        if not headers:
+            return pd.DataFrame()
+        with self.lock:
+            df = pd.read_sql_query(f"SELECT * FROM {table} ORDER BY _row", self.conn)
+        return df.drop(columns="_row")
+
+    def append_row(self, table, values):
+        """シートの末尾に追加した行をレプリカにも追加する."""
+        headers = self.headers(table)
+        if headers is None:
+            return  # 未同期の場合は次回の同期で取り込まれる
+        row = _pad_row([("" if value is None else str(value)) for value in values], len(headers))
+        with self.lock, self.conn:
+            next_row = self.conn.execute(f"SELECT COALESCE(MAX(_row), 1) + 1 FROM {table}").fetchone()[0]
+            self.conn.execute(f"INSERT INTO {table} VALUES ({', '.join('?' * (len(headers) + 1))})", (next_row, *row))
+            self.local_writes += 1
+            self.versions[table] += 1
+
+    def update_row(self, table, sheet_row, updates):
+        """シートの sheet_row 行目の更新 {列名: 値} をレプリカにも反映する."""
+        headers = self.headers(table) or []
+        updates = {column: value for column, value in updates.items() if column in headers}
+        if not updates:
+            return
+        assignments = ", ".join(f"{_quote(column)} = ?" for column in updates)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"UPDATE {table} SET {assignments} WHERE _row = ?",
+                (*[("" if value is None else str(value)) for value in updates.values()], sheet_row),
+            )
+            self.local_writes += 1
+            self.versions[table] += 1
+
+    def delete_row(self, table, sheet_row):
+        """シートの sheet_row 行目の削除をレプリカにも反映し、後ろの行番号を詰める."""
+        if self.headers(table) is None:
+            return
+        with self.lock, self.conn:
+            self.conn.execute(f"DELETE FROM {table} WHERE _row = ?", (sheet_row,))
+            self.conn.execute(f"UPDATE {table} SET _row = _row - 1 WHERE _row > ?", (sheet_row,))
+            self.local_writes += 1
+            self.versions[table] += 1
+
+@st.cache_resource  # プロセス内で1つの接続を共有
+def get_replica():
+    with get_startup_report().measure("ローカルレプリカを開く (SQLite)"):
+        return SheetReplica(REPLICA_PATH)
+
+def sync_replica(replica=None, full=False):
+    """顧客・施術履歴シートをレプリカに同期する.
+
+    顧客シートは毎回全件、追記のみの施術履歴シートは追加された行だけを取得する。
+    両シートの範囲は1回の values.batchGet でまとめて取得する (同じ時点の内容になる)。
+    full=True なら両方とも全件取り直す。
+    """
+    replica = replica or get_replica()
+    # 送信待ちの書き込みがシートに反映されてから取得し (反映前のデータで上書きしないため)、
+    # ID を書き込み終わるまでキューの送信を止めておく (行の削除で書き込み先がずれないため)
+    with get_write_queue().paused():
+        writes = replica.local_writes
+        # テーブルごとの取得範囲 (差分同期できないテーブルはシート全体)
+        plans = {table: None if full or table != "treatments" else incremental_ranges(replica, table)
+                 for table in REPLICA_TABLES}
+        ranges = [a1 for table, plan in plans.items() for a1 in (plan or [sheet_range(table)])]
+        results = iter(batch_get_values(ranges))
+
+        refetch = []
+        for table, plan in plans.items():
+            if plan is None:
+                replace_from_values(replica, table, next(results), writes)
+            elif not apply_incremental_rows(replica, table, next(results), next(results), writes):
+                refetch.append(table)
+        # 差分同期できなかった (行の削除・編集があった) テーブルだけ全件取り直す
+        if refetch:
+            for table, values in zip(refetch, batch_get_values([sheet_range(table) for table in refetch])):
+                replace_from_values(replica, table, values, writes)
+
+def sheet_range(table, a1=None):
+    """レプリカのテーブルに対応するシートの範囲 (a1 が None ならシート全体)."""
+    return gspread.utils.absolute_range_name(REPLICA_TABLES[table][0], a1)
+
+def batch_get_values(ranges):
+    """データベースのスプレッドシートから複数の範囲を1回の values.batchGet で取得する.
+
+    範囲ごとの値 (行のリスト。末尾の空セル・空行は省略される) を ranges と同じ順で返す。
+    """
+    spreadsheet = open_spreadsheet(GOOGLE_DATABASE_SHEET_NAME)
+    with api_label(f"sheets.values_batch_get ({GOOGLE_DATABASE_SHEET_NAME})"):
+        response = spreadsheet.values_batch_get(ranges)
+    return [value_range.get("values", []) for value_range in response.get("valueRanges", [])]
+
+def replace_from_values(replica, table, values, writes):
+    """シート全体の値でテーブルを置き換える (ID のない行があればシートに ID を書き込む)."""
+    worksheet = open_worksheet(GOOGLE_DATABASE_SHEET_NAME, REPLICA_TABLES[table][0])
+    replica.replace_table(table, ensure_record_ids(worksheet, values), if_unchanged_since=writes)
+
+def ensure_record_ids(worksheet, values):
+    """ID 列がなければ追加し、ID のない行に ID を振る (シートにも1回のバッチ更新で書き込む).
+
+    シートを直接編集して追加された行にもここで ID が振られる。ID を補った values を返す。
+    values を読んでから書き込むまで行がずれないよう、書き込みキューを止めた状態で呼ぶこと
+    (SheetWriteQueue.paused)。
+    """
+    if not values:
+        return values
+    headers = list(values[0])
+    updates = []
+    if ID_COLUMN not in headers:
+        headers.append(ID_COLUMN)
+        if worksheet.col_count < len(headers):
+            worksheet.add_cols(len(headers) - worksheet.col_count)
+        updates.append({"range": gspread.utils.rowcol_to_a1(1, len(headers)), "values": [[ID_COLUMN]]})
+
+    id_index = headers.index(ID_COLUMN)
+    rows = [_pad_row(row, len(headers)) for row in values[1:]]
+    for sheet_row, row in enumerate(rows, start=2):
+        if not row[id_index] and any(row):  # 空行には振らない
+            row[id_index] = new_record_id()
+            updates.append({"range": gspread.utils.rowcol_to_a1(sheet_row, id_index + 1), "values": [[row[id_index]]]})
+
+    if updates:
+        worksheet.batch_update(updates)
+    return [headers, *rows]
+
+def incremental_ranges(replica, table):
+    """差分同期で取得する範囲 [ヘッダー行, 前回の最終行以降]。全件同期が必要なら None.
+
+    一定時間全件同期していない場合は None を返す (シート途中の直接編集への安全策)。
+    """
+    meta = replica.sync_meta(table)
+    if meta is None or time.time() - meta["full_synced_at"] > REPLICA_FULL_SYNC_INTERVAL:
+        return None
+    last_column = re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, max(len(meta["headers"]), 1)))
+    return [sheet_range(table, "1:1"), sheet_range(table, f"A{replica.last_row(table)}:{last_column}")]
+
+def apply_incremental_rows(replica, table, header_range, tail_range, writes):
+    """incremental_ranges の範囲の取得結果から、追加された行だけをレプリカに追記する.
+
+    ヘッダーのチェックサムと前回の最終行の内容が変わっていなければ追記分だけを反映する。
+    行の削除・編集でこれらが一致しない場合は False を返す (全件同期へ)。
+    """
+    if writes != replica.local_writes:
+        return True  # 取得中にライトスルーがあった。追加された行は次回の同期で取り込む
+    meta = replica.sync_meta(table)
+    last_row = replica.last_row(table)
+
+    headers = header_range[0] if header_range else []
+    if meta is None or header_checksum(headers) != meta["header_checksum"]:
+        return False  # 列の追加・変更
+
+    # 取得範囲の先頭は前回の最終行。内容が変わっていれば削除か編集があった
+    tail = list(tail_range)
+    if not tail or _pad_row(tail[0], len(headers)) != replica.row_values(table, last_row):
+        return False
 
-            # 「顧客名」→「フリガナ」の辞書を作成
-            customer_furigana_map = dict(zip(df_customers["顧客名"], df_customers["フリガナ"]))
+    # シートに直接追加された ID のない行があれば、全件同期で ID を振る
+    new_rows = tail[1:]
+    id_index = headers.index(ID_COLUMN) if ID_COLUMN in headers else None
+    if any(any(row) and (id_index is None or not _pad_row(row, len(headers))[id_index]) for row in new_rows):
+        return False
 
-            # 施術履歴に「フリガナ」列を追加（該当する顧客名があれば追加、なければ空白）
-            df_treatments["フリガナ"] = df_treatments["顧客名"].map(customer_furigana_map).fillna("")
+    # 取得中にライトスルーがあった場合は次回の同期で取り込む
+    replica.append_synced_rows(table, new_rows, if_unchanged_since=writes)
+    return True
+
+def append_record(table, row, record_id):
+    """build_row で作った行の追加をシートとレプリカに反映し、書き込みの Future を返す.
+
+    キューとレプリカに同じ順で入るよう、登録から write_through までレプリカのロックを持つ。
+    """
+    worksheet = open_worksheet(GOOGLE_DATABASE_SHEET_NAME, REPLICA_TABLES[table][0])
+    queue = get_write_queue()
+    with get_replica().lock:
+        future = queue.append_row(worksheet.id, row, record_id)
+        write_through(table, "append_row", row)
+    return future
+
+def write_record(table, record_id, updates=None):
+    """ID の行の更新 (updates={列名: 値}) または削除 (updates=None) をシートとレプリカに反映する.
+
+    行番号をレプリカの ID インデックスから引いてから、書き込みキューへの登録と write_through が
+    終わるまでレプリカのロックを持ち続ける (その間に他のセッションの削除で行がずれないように)。
+    シート上の行番号は送信時にキューが ID 列から引き直す。レプリカにない ID はシートに直接
+    追加された行かもしれないので、全件同期してから引き直す。
+    書き込みの Future を返す (行が見つからなければ None)。
+    """
+    replica = get_synced_replica()
+    if replica.find_row(table, record_id) is None:
+        sync_replica(replica, full=True)
+    worksheet = open_worksheet(GOOGLE_DATABASE_SHEET_NAME, REPLICA_TABLES[table][0])
+    queue = get_write_queue()
+    with replica.lock:
+        sheet_row = replica.find_row(table, record_id)
+        if sheet_row is None:
+            return None
+        id_range = record_id_range(table)
+        if updates is None:
+            future = queue.delete_row(worksheet.id, id_range, record_id, sheet_row)
+            write_through(table, "delete_row", sheet_row)
+        else:
+            headers = replica.headers(table)
+            cells = {headers.index(column) + 1: value for column, value in updates.items()}
+            future = queue.update_cells(worksheet.id, id_range, record_id, cells, sheet_row)
+            write_through(table, "update_row", sheet_row, updates)
+    return future
+
+def build_row(table, values):
+    """追加する行をシートのヘッダー順に並べ、ID 列に新しい ID を入れる.
+
+    values は ID 以外の列を先頭から並べたリスト。(行, ID) を返す。
+    """
+    headers = get_synced_replica().headers(table) or []
+    row = _pad_row(["" if value is None else value for value in values], len(headers))
+    record_id = new_record_id()
+    if ID_COLUMN in headers:
+        row[headers.index(ID_COLUMN)] = record_id
+    return row, record_id
+
+def get_synced_replica():
+    """同期済みのレプリカを返す。ローカルにデータがない初回だけシートから同期する."""
+    replica = get_replica()
+    if not replica.is_synced():
+        with get_startup_report().measure("レプリカの初回同期 (Sheets)"):
+            sync_replica(replica)
+    return replica
+
+@st.cache_resource  # プロセスにつき1つだけ起動
+def start_replica_sync():
+    """レプリカをシートと定期的に同期するバックグラウンドスレッドを起動する."""
+    replica = get_replica()
+
+    def run():
+        while True:
+            time.sleep(REPLICA_SYNC_INTERVAL)
+            try:
+                sync_replica(replica)
+            except Exception as e:
+                print(f"レプリカの同期に失敗しました: {e}")
+
+    thread = threading.Thread(target=run, name="replica-sync", daemon=True)
+    thread.start()
+    return thread
+
+# シート書き込みキュー: 追加・更新・削除をためて1回のバッチリクエストで送る
+WRITE_QUEUE_FLUSH_INTERVAL = float(config.get("write_queue_flush_interval", 0.5))  # 送信までに待つ秒数
+WRITE_QUEUE_MAX_BATCH = int(config.get("write_queue_max_batch", 50))  # この件数たまったらすぐ送る
+WRITE_RETRY_STATUSES = {429, 500, 502, 503, 504}  # 再試行する HTTP ステータス
+WRITE_MAX_RETRIES = 5
+
+def execute_with_backoff(request):
+    """googleapiclient のリクエストを実行し、429/5xx なら指数バックオフで再試行する."""
+    for attempt in range(WRITE_MAX_RETRIES):
+        try:
+            return request.execute()
+        except errors.HttpError as error:
+            if error.resp.status not in WRITE_RETRY_STATUSES or attempt == WRITE_MAX_RETRIES - 1:
+                raise
+            time.sleep(min(2 ** attempt, 32) + random.random())
+
+def batch_get_with_backoff(ranges):
+    """batch_get_values を実行し、429/5xx なら指数バックオフで再試行する."""
+    for attempt in range(WRITE_MAX_RETRIES):
+        try:
+            return batch_get_values(ranges)
+        except gspread.exceptions.APIError as error:
+            if error.code not in WRITE_RETRY_STATUSES or attempt == WRITE_MAX_RETRIES - 1:
+                raise
+            time.sleep(min(2 ** attempt, 32) + random.random())
+
+def _cell_data(value):
+    # 入力値はそのまま文字列として保存する (電話番号の先頭の 0 などを保つ)
+    return {"userEnteredValue": {"stringValue": "" if value is None else str(value)}}
+
+def record_id_range(table):
+    """書き込みキューが行番号を引くための、シートの ID 列全体の範囲."""
+    headers = get_replica().headers(table) or []
+    column = re.sub(r"\d", "", gspread.utils.rowcol_to_a1(1, headers.index(ID_COLUMN) + 1))
+    return sheet_range(table, f"{column}:{column}")
+
+class SheetWriteQueue:
+    """スプレッドシートへの書き込み (行の追加・セルの更新・行の削除) をためて送るキュー.
+
+    各操作は concurrent.futures.Future を返すので、画面側はそれで完了や失敗を確認できる。
+    バックグラウンドのスレッドが WRITE_QUEUE_FLUSH_INTERVAL 秒ごと (または
+    WRITE_QUEUE_MAX_BATCH 件たまった時点) に、たまった操作を順番どおり1回の
+    spreadsheets.batchUpdate にまとめて送る。更新・削除は行番号ではなく ID で登録し、
+    送る直前にシートの ID 列 (id_range) を読んで行番号を引く。前の送信が失敗していても、
+    操作はシートの今の内容で正しい行に当たる。
+    """
+
+    def __init__(self, spreadsheet_id, on_failure=None):
+        self.spreadsheet_id = spreadsheet_id
+        self.on_failure = on_failure  # 送信に失敗した・レプリカとシートの行がずれていたときの後始末
+        self.pending = []  # (操作, Future) のリスト
+        self.in_flight = 0
+        self.paused_count = 0  # paused() の中にいるスレッドの数 (その間は送らない)
+        self.first_pending_at = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="sheet-write-queue", daemon=True)
+        self.thread.start()
+
+    def append_row(self, sheet_id, row, record_id=None):
+        """シートの末尾に行を追加する (record_id はその行の ID。同じバッチで更新・削除するときに使う)."""
+        return self._enqueue({"sheet_id": sheet_id, "record_id": record_id, "requests": lambda sheet_row: [
+            {"appendCells": {
+                "sheetId": sheet_id,
+                "rows": [{"values": [_cell_data(value) for value in row]}],
+                "fields": "userEnteredValue",
+            }}
+        ]})
+
+    def update_cells(self, sheet_id, id_range, record_id, cells, expected_row=None):
+        """ID が record_id の行のセルを更新する。cells: {列番号 (1-based): 値}.
+
+        expected_row にはレプリカ上の行番号を渡す (シートとずれていたら on_failure でレプリカを作り直させる)。
+        """
+        return self._enqueue({"sheet_id": sheet_id, "id_range": id_range, "record_id": record_id,
+                              "expected_row": expected_row, "requests": lambda sheet_row: [
+            {"updateCells": {
+                "range": {"sheetId": sheet_id, "startRowIndex": sheet_row - 1, "endRowIndex": sheet_row,
+                          "startColumnIndex": col - 1, "endColumnIndex": col},
+                "rows": [{"values": [_cell_data(value)]}],
+                "fields": "userEnteredValue",
+            }} for col, value in cells.items()
+        ]})
+
+    def delete_row(self, sheet_id, id_range, record_id, expected_row=None):
+        """ID が record_id の行を削除する (引数の意味は update_cells と同じ)."""
+        return self._enqueue({"sheet_id": sheet_id, "id_range": id_range, "record_id": record_id,
+                              "expected_row": expected_row, "delete": True, "requests": lambda sheet_row: [
+            {"deleteDimension": {
+                "range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": sheet_row - 1, "endIndex": sheet_row},
+            }}
+        ]})
+
+    def _enqueue(self, operation):
+        future = Future()
+        with self.condition:
+            self.pending.append((operation, future))
+            if self.first_pending_at is None:
+                self.first_pending_at = time.monotonic()
+            self.condition.notify_all()
+        return future
+
+    def drain(self, timeout=None):
+        """たまっている操作をすぐに送り、送信し終わるまで待つ."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            self.first_pending_at = 0 if self.pending else None  # 待ち時間を打ち切ってすぐ送る
+            self.condition.notify_all()
+            while self.pending or self.in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
 
-            return df_treatments
+    @contextmanager
+    def paused(self):
+        """送信待ちの操作を送り切ってから、ブロックを抜けるまで次の送信を止める.
+
+        シートを読んでから行番号で書き込むまでの間に、キューの削除で行がずれないようにする。
+        ブロックの中で drain() を呼ばないこと。
+        """
+        with self.condition:
+            while self.pending or self.in_flight:
+                if self.pending and not self.paused_count:
+                    self.first_pending_at = 0  # 待ち時間を打ち切ってすぐ送る
+                    self.condition.notify_all()
+                self.condition.wait()
+            self.paused_count += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.paused_count -= 1
+                self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.paused_count:
+                        self.condition.wait()
+                    elif self.pending:
+                        waited = time.monotonic() - self.first_pending_at
+                        if waited >= WRITE_QUEUE_FLUSH_INTERVAL or len(self.pending) >= WRITE_QUEUE_MAX_BATCH:
+                            break
+                        self.condition.wait(WRITE_QUEUE_FLUSH_INTERVAL - waited)
+                    else:
+                        self.condition.wait()
+                batch, self.pending = self.pending, []
+                self.first_pending_at = None
+                self.in_flight = len(batch)
+            try:
+                while batch:
+                    batch = batch[self._flush(batch):]
+            finally:
+                with self.condition:
+                    self.in_flight = 0
+                    self.condition.notify_all()
+
+    def _flush(self, batch):
+        """batch の先頭から順番どおり1回の batchUpdate で送り、処理した操作の数を返す.
+
+        更新・削除の行番号はシートの ID 列から引き、バッチ内の削除による行のずれも反映する。
+        同じバッチで追加した行への更新・削除は、追加がシートに入ってから引くためそこで区切る。
+        連続する追加は1つの appendCells にまとめる。
+        """
+        ranges = list(dict.fromkeys(operation["id_range"] for operation, _ in batch if "id_range" in operation))
+        try:
+            record_ids = {a1: [row[0] if row else "" for row in values]  # シートの行番号 - 1 の位置に ID
+                          for a1, values in zip(ranges, batch_get_with_backoff(ranges) if ranges else [])}
+        except Exception as e:
+            self._fail(batch, e)
+            return len(batch)
+
+        requests, sent, appended, moved = [], [], set(), False
+        count = 0
+        for operation, future in batch:
+            record_id = operation["record_id"]
+            if "id_range" in operation:
+                if record_id in appended:
+                    break
+                ids = record_ids[operation["id_range"]]
+                if record_id not in ids:
+                    future.set_exception(LookupError(f"ID {record_id} の行がシートに見つかりませんでした。"))
+                    moved = True
+                    count += 1
+                    continue
+                sheet_row = ids.index(record_id) + 1
+                moved = moved or sheet_row != operation.get("expected_row", sheet_row)
+                if operation.get("delete"):
+                    del ids[sheet_row - 1]  # 後ろの行は1つ上がる
+            else:
+                sheet_row = None
+                appended.add(record_id)
+            for request in operation["requests"](sheet_row):
+                previous = requests[-1] if requests else None
+                if ("appendCells" in request and previous and "appendCells" in previous
+                        and previous["appendCells"]["sheetId"] == request["appendCells"]["sheetId"]):
+                    previous["appendCells"]["rows"].extend(request["appendCells"]["rows"])
+                else:
+                    requests.append(request)
+            sent.append((operation, future))
+            count += 1
+
+        if moved:
+            print("レプリカとシートの行がずれていたので、次の読み込みで全件取り直します。")
+            if self.on_failure:
+                self.on_failure()
+        if not requests:
+            return count
+        try:
+            service = get_google_resources().service('sheets', 'v4')
+            response = execute_with_backoff(service.spreadsheets().batchUpdate(
+                spreadsheetId=self.spreadsheet_id, body={"requests": requests}))
+        except Exception as e:
+            self._fail(sent, e)
+            return count
+        for _, future in sent:
+            future.set_result(response)
+        return count
+
+    def _fail(self, batch, error):
+        print(f"シートへの書き込みに失敗しました ({len(batch)} 件): {error}")
+        for _, future in batch:
+            future.set_exception(error)
+        if self.on_failure:
+            self.on_failure()
+
+@st.cache_resource  # プロセス内で1つのキューを共有
+def get_write_queue():
+    replica = get_replica()
+    snapshots = get_snapshot_cache()
+
+    def on_failure():
+        # 送信に失敗したらレプリカと共有スナップショットはシートとずれている (書けなかった変更が
+        # 反映済みになっている) ので、次の読み込みでシートから取り直す
+        replica.invalidate()
+        snapshots.invalidate()
+
+    queue = SheetWriteQueue(open_spreadsheet(GOOGLE_DATABASE_SHEET_NAME).id, on_failure=on_failure)
+    atexit.register(queue.drain, timeout=30)  # 終了時に未送信の操作を送る
+    return queue
+
+def track_write(label, future):
+    """書き込みの完了を後で確認できるよう、Future をセッションに記録する."""
+    st.session_state.setdefault("pending_writes", []).append((label, future))
+
+def show_write_status():
+    """セッションで行った書き込みのうち、失敗したものと送信待ちの件数を表示する."""
+    pending = []
+    for label, future in st.session_state.get("pending_writes", []):
+        if not future.done():
+            pending.append((label, future))
+        elif future.exception() is not None:
+            st.error(f"❌ {label}をシートに反映できませんでした: {future.exception()}")
+    st.session_state["pending_writes"] = pending
+    if pending:
+        st.caption(f"⏳ シートへの反映待ち: {len(pending)} 件")
+
+# 顧客・施術履歴のスナップショット: 全セッションで共有し、古くなったら裏で読み直す
+SNAPSHOT_TTL = int(config.get("snapshot_ttl", 60))  # この秒数を過ぎたら読み直す (その間も古いものを返す)
+# 書き込みはスナップショットに直接反映するが、安全策としてこの間隔 (秒) ごとにレプリカから全体を読み直す
+SNAPSHOT_FULL_RESYNC_INTERVAL = int(config.get("snapshot_full_resync_interval", 600))
+
+class SnapshotCache:
+    """stale-while-revalidate で共有するスナップショット.
+
+    TTL を過ぎた後の参照では古いスナップショットをすぐに返し、バックグラウンドの
+    スレッドで読み直してから差し替える。差し替えは参照1つの入れ替えなので、読む側に
+    途中の状態は見えない。多数のセッションで同時に TTL が切れても読み直すのは1回だけ。
+    スナップショットがない初回と invalidate() の後だけは、読み込みが終わるまで待つ。
+    load には今のスナップショット (初回は None) を渡し、変わっていなければそれを返してよい。
+    """
+
+    def __init__(self, load, ttl, name):
+        self.load = load
+        self.ttl = ttl
+        self.name = name
+        self.lock = threading.Lock()  # current・refreshing・generation を守る
+        self.load_lock = threading.Lock()  # 読み込みは1スレッドずつ
+        self.current = None  # (スナップショット, 読み込んだ時刻)
+        self.refreshing = False
+        self.generation = 0  # invalidate() のたびに増やす (無効化より前に始めた読み込みの結果は捨てる)
+
+    def get(self):
+        with self.lock:
+            current = self.current
+            stale = current is not None and time.monotonic() - current[1] > self.ttl and not self.refreshing
+            if stale:
+                self.refreshing = True
+        if current is None:
+            return self._load_now()
+        if stale:
+            threading.Thread(target=self._refresh, name=f"{self.name}-refresh", daemon=True).start()
+        return current[0]
+
+    def _load_now(self):
+        with self.load_lock:
+            with self.lock:
+                current, generation = self.current, self.generation
+            if current is not None:
+                return current[0]  # 待っている間に他のスレッドが読み込んだ
+            snapshot = self.load(None)
+            self._swap(generation, snapshot)
+            return snapshot
+
+    def _refresh(self):
+        try:
+            with self.load_lock:
+                with self.lock:
+                    generation, current = self.generation, self.current
+                snapshot = self.load(current and current[0])
+            self._swap(generation, snapshot)
+        except Exception as e:
+            print(f"スナップショットの再読み込みに失敗しました (前回の内容を使います): {e}")
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def _swap(self, generation, snapshot):
+        with self.lock:
+            if generation == self.generation:
+                self.current = (snapshot, time.monotonic())
+
+    def patch(self, update):
+        """スナップショットを update(今のスナップショット) が返すものに差し替える (読み込んだ時刻はそのまま).
+
+        update が None を返したら invalidate() と同じく、次の参照で読み直させる。
+        """
+        with self.lock:
+            if self.current is None:
+                return
+            snapshot = update(self.current[0])
+            self.generation += 1  # 変更より前に始めた読み込みの結果は捨てる
+            self.current = None if snapshot is None else (snapshot, self.current[1])
+
+    def invalidate(self):
+        """次の参照で読み直させる (古いスナップショットは返さない)."""
+        with self.lock:
+            self.generation += 1
+            self.current = None
+
+# スナップショットの列の型: 読み込み時に一度だけ変換する (レプリカ・シートではすべて文字列)
+DATE_COLUMNS = ["日付"]  # datetime64 (空欄・不正な日付は NaT)。シートの入力値も date_text_column に残す
+CATEGORY_COLUMNS = ["顧客名", "施術内容"]  # 同じ値が何度も出てくるので category で持つ
+TEXT_DTYPE = pd.StringDtype("pyarrow")  # その他の自由入力の列 (pyarrow は streamlit の依存で入っている)
+
+def parse_dates(values):
+    """日付の文字列の Series を datetime64 にする (ISO 形式以外の "2024/01/05" なども解釈する)."""
+    dates = pd.to_datetime(values, errors="coerce", format="ISO8601")
+    retry = dates.isna() & (values != "")
+    if retry.any():  # ISO 形式で読めなかったものだけ1つずつ解釈する
+        dates[retry] = pd.to_datetime(values[retry], errors="coerce", format="mixed")
+    return dates
+
+def date_text_column(column):
+    """日付の列のシートの入力値 ("2024/01/05" や日付でないメモなど) を残しておく列の名前."""
+    return f"{column}（入力値）"
+
+def apply_schema(df):
+    """レプリカから読んだ文字列の列をスナップショットの型にした DataFrame を返す."""
+    columns = {}
+    for column in df.columns:
+        if column in DATE_COLUMNS:
+            columns[column] = parse_dates(df[column])
+            columns[date_text_column(column)] = df[column].astype(TEXT_DTYPE)
+        elif column in CATEGORY_COLUMNS:
+            columns[column] = df[column].astype("category")
+        else:
+            columns[column] = df[column].astype(TEXT_DTYPE)
+    return pd.DataFrame(columns, index=df.index)
+
+def column_text(series):
+    """列を表示・検索用の文字列にする (日付は YYYY-MM-DD、欠損は空文字)."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.dt.strftime("%Y-%m-%d").fillna("")
+    return series.astype(TEXT_DTYPE).fillna("")
+
+def date_text(df, column):
+    """日付の列の表示用の文字列 (YYYY-MM-DD。日付として読めなかった行はシートの入力値のまま)."""
+    text = column_text(df[column])
+    raw = date_text_column(column)
+    if raw not in df.columns:
+        return text
+    return text.where(df[column].notna(), column_text(df[raw]))
+
+def has_unparsed_dates(df, column):
+    """日付として読めなかった入力値 (空欄以外) がある行があるか."""
+    raw = date_text_column(column)
+    return raw in df.columns and bool((df[column].isna() & (df[raw].fillna("") != "")).any())
+
+def align_categories(df, other):
+    """category の列のカテゴリを揃えた (df, other) を返す (連結しても category のままにするため)."""
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns and column in other.columns:
+            added = other[column].cat.categories.difference(df[column].cat.categories)
+            if len(added):  # 新しい顧客名・施術内容のときだけ。既存のコードはそのまま使う
+                dtype = pd.CategoricalDtype(df[column].cat.categories.append(added))
+                df = df.assign(**{column: pd.Categorical.from_codes(df[column].cat.codes, dtype=dtype)})
+            other = other.assign(**{column: other[column].astype(df[column].dtype)})
+    return df, other
+
+def customer_search_keys(df_customers):
+    """検索用の正規化キー (顧客名とフリガナ)."""
+    # category の列はカテゴリごとに1回だけ正規化される
+    return (df_customers["顧客名"].map(normalize_search_key).astype(TEXT_DTYPE) + "\x00"
+            + df_customers["フリガナ"].map(normalize_search_key).astype(TEXT_DTYPE))
+
+def treatment_furigana(df_treatments, df_customers):
+    """施術履歴の各行の顧客のフリガナ（該当する顧客名があれば追加、なければ空白）."""
+    if "顧客名" not in df_customers.columns:
+        return pd.Series("", index=df_treatments.index, dtype=TEXT_DTYPE)
+    # 同じ顧客名が複数あれば後の行を使う
+    customer_furigana = df_customers.drop_duplicates("顧客名", keep="last").set_index("顧客名")["フリガナ"]
+    return df_treatments["顧客名"].map(customer_furigana).astype(TEXT_DTYPE).fillna("")
+
+def add_derived_columns(table, df, df_customers):
+    """レプリカの列から作る列 (顧客の検索キー・施術履歴のフリガナ) を追加する."""
+    if table == "customers" and "顧客名" in df.columns:
+        df["検索キー"] = customer_search_keys(df)
+    elif table == "treatments" and "顧客名" in df.columns:
+        df["フリガナ"] = treatment_furigana(df, df_customers)
+    return df
+
+def make_snapshot(df_customers, df_treatments, versions, read_at, furigana_version=None):
+    # 検索インデックスの作り直しが必要か判定できるよう、データのバージョンを付けておく。
+    # 施術履歴のフリガナは顧客から付けるので、最後にフリガナが変わった顧客のバージョンも含める
+    df_customers.attrs["data_version"] = versions["customers"]
+    df_treatments.attrs["data_version"] = (versions["treatments"], versions["customers"] if furigana_version is None else furigana_version)
+    return {"customers": df_customers, "treatments": df_treatments, "versions": versions, "read_at": read_at}
+
+def read_database_snapshot(previous=None):
+    """顧客・施術履歴を同じ時点のレプリカから読み込み、スナップショットを返す.
+
+    スナップショットは {"customers": 顧客, "treatments": 施術履歴, "versions": レプリカのバージョン,
+    "read_at": 全体を読んだ時刻}。列は apply_schema の型にし、施術履歴には顧客のフリガナを
+    結合しておく。全セッションで
+    共有するので書き換えないこと (画面からは load_customers / load_treatments_with_furigana が
+    返すコピーを使う)。previous とレプリカのバージョンが同じで、全体を読み直す間隔も
+    過ぎていなければ previous をそのまま返す。
+    """
+    replica = get_synced_replica()
+    with replica.lock:  # 両テーブルを同じ時点の内容で読む
+        versions = {table: replica.versions[table] for table in REPLICA_TABLES}
+        if (previous is not None and previous["versions"] == versions
+                and time.time() - previous["read_at"] < SNAPSHOT_FULL_RESYNC_INTERVAL):
+            return previous
+        df_customers = apply_schema(replica.read_frame("customers"))
+        df_treatments = apply_schema(replica.read_frame("treatments"))
+
+    add_derived_columns("customers", df_customers, None)
+    add_derived_columns("treatments", df_treatments, df_customers)
+    return make_snapshot(df_customers, df_treatments, versions, time.time())
+
+def patch_snapshot(snapshot, replica, table, operation, *args):
+    """レプリカの1行の変更 (SheetReplica の append_row / update_row / delete_row) を反映した
+    新しいスナップショットを返す。元のスナップショットは変更しない.
+
+    スナップショットが変更直前のレプリカと同じバージョンでなければ None を返す (読み直す)。
+    """
+    versions = dict(snapshot["versions"])
+    headers = replica.headers(table)
+    df = snapshot[table]
+    if headers is None or versions[table] != replica.versions[table] - 1 or len(df.columns) == 0:
+        return None
+    versions[table] += 1
+    frames = {"customers": snapshot["customers"], "treatments": snapshot["treatments"]}
+
+    def changed_row(sheet_row):
+        # 変更後の行をレプリカから読み、全体を読み込んだときと同じ型・列にする
+        row = apply_schema(pd.DataFrame([replica.row_values(table, sheet_row)], columns=headers))
+        return align_categories(df, add_derived_columns(table, row, frames["customers"]))
+
+    if operation == "append_row":
+        df, row = changed_row(replica.last_row(table))
+        df = pd.concat([df, row], ignore_index=True)
+    elif operation == "update_row":
+        sheet_row = args[0]
+        position = sheet_row - 2  # スナップショットの行はシートの行順 (2行目から)
+        df, row = changed_row(sheet_row)
+        df = pd.concat([df.iloc[:position], row, df.iloc[position + 1:]], ignore_index=True)
+    elif operation == "delete_row":
+        (sheet_row,) = args
+        df = df.drop(index=sheet_row - 2).reset_index(drop=True)
+    else:
+        return None
+    frames[table] = df
+
+    # 顧客名・フリガナが変わったかもしれないので、施術履歴のフリガナを付け直す
+    # (変わっていなければ施術履歴はそのまま。施術履歴のインデックスを作り直さないため)
+    furigana_version = snapshot["treatments"].attrs.get("data_version", (None, None))[1]
+    if table == "customers" and "顧客名" in frames["treatments"].columns:
+        furigana = treatment_furigana(frames["treatments"], frames["customers"])
+        if "フリガナ" not in frames["treatments"].columns or not furigana.equals(frames["treatments"]["フリガナ"]):
+            frames["treatments"] = frames["treatments"].assign(フリガナ=furigana)
+            furigana_version = versions["customers"]
+    return make_snapshot(frames["customers"], frames["treatments"], versions, snapshot["read_at"], furigana_version)
+
+def write_through(table, operation, *args):
+    """シートに送った1行の変更をレプリカと共有スナップショットにもすぐ反映する.
+
+    operation は SheetReplica のメソッド名 (append_row / update_row / delete_row)。
+    スナップショットは全体を読み直さず、その行だけを差し替える。
+    """
+    replica = get_replica()
+    with replica.lock:  # レプリカとスナップショットを同じ順で変更する
+        getattr(replica, operation)(table, *args)
+        get_snapshot_cache().patch(lambda snapshot: patch_snapshot(snapshot, replica, table, operation, *args))
+
+@st.cache_resource  # 全セッションで1つを共有する
+def get_snapshot_cache():
+    return SnapshotCache(read_database_snapshot, SNAPSHOT_TTL, "database-snapshot")
+
+def load_database_snapshot():
+    return get_snapshot_cache().get()
+
+def load_treatments_with_furigana():
+    """施術履歴に顧客情報のフリガナを追加"""
+    try:
+        with st.spinner("施術履歴を読み込み中..."): # ローディングインジケーター
+            return load_database_snapshot()["treatments"].copy()
     except gspread.exceptions.WorksheetNotFound:
         st.error(f"シート '{GOOGLE_TREATMENTS_SHEET_NAME}' または '{GOOGLE_CUSTOMERS_SHEET_NAME}' が見つかりません。")
         return pd.DataFrame()  # 空の DataFrame を返す
@@ -251,40 +1892,90 @@ def format_phone_number(phone_number):
 
     return formatted_phone
 
-def load_users():
-    sheet = client.open(GOOGLE_SHEET_NAME).sheet1
-    data = sheet.get_all_records()
-    return pd.DataFrame(data)
+# ユーザー名簿: メールアドレス → パスワードのハッシュ・FaceID をプロセス内で共有する
+USER_DIRECTORY_TTL = int(config.get("user_directory_ttl", 300))  # 名簿を読み直す間隔 (秒)
+USER_DIRECTORY_MISS_REFRESH = 30  # 未登録のメールアドレスで読み直すのは、前回からこの秒数が過ぎたときだけ
+
+class UserDirectory:
+    """ログイン用のユーザー名簿 (メールアドレス → {"Password": ハッシュ, "FaceID": ID}).
+
+    TTL が過ぎたか invalidate() された後の最初の参照で、シートを1回だけ読み直す。
+    同時に多数のログインがあっても読み直すのは1スレッドだけで、他は結果を待つ。
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.users = {}
+        self.loaded_at = None
+
+    def _refresh(self):
+        with get_startup_report().measure("ユーザー名簿の読み込み"):
+            records = open_worksheet(GOOGLE_SHEET_NAME).get_all_records()
+        self.users = {
+            str(record["Email"]): {"Password": str(record.get("Password", "")), "FaceID": str(record.get("FaceID", ""))}
+            for record in records if record.get("Email")
+        }
+        self.loaded_at = time.monotonic()
+
+    def get(self, max_age=None):
+        """名簿の辞書を返す。max_age 秒より古ければ (既定は TTL) 読み直す."""
+        max_age = self.ttl if max_age is None else max_age
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > max_age:
+                try:
+                    self._refresh()
+                except Exception as e:
+                    if not self.users:
+                        raise
+                    print(f"ユーザー名簿の再読み込みに失敗しました (前回の内容を使います): {e}")
+            return self.users
+
+    def lookup(self, email):
+        user = self.get().get(email)
+        if user is None:
+            # シートに追加したばかりのユーザーでも TTL を待たずにログインできるように
+            user = self.get(max_age=USER_DIRECTORY_MISS_REFRESH).get(email)
+        return user
+
+    def invalidate(self):
+        """次の参照でシートから読み直させる (ユーザーを追加・変更したときに呼ぶ)."""
+        with self.lock:
+            self.loaded_at = None
+
+@st.cache_resource  # 全セッションで共有する
+def get_user_directory():
+    return UserDirectory(USER_DIRECTORY_TTL)
 
 def authenticate_email_password(email, password):
-    users = load_users()
-    hashed_input = hash_password(password)
-    if any((users['Email'] == email) & (users['Password'] == hashed_input)):
-        return True
-    return False
+    user = get_user_directory().lookup(email)
+    if user is None:
+        return False
+    return hmac.compare_digest(user["Password"], hash_password(password))
 
 def authenticate_face(uploaded_image):
     try:
-        users = load_users()
-        if users is None:
-            st.error("ユーザーデータの読み込みに失敗しました。")
-            return None
+        users = get_user_directory().get()
 
-        for index, row in users.iterrows():
-            registered_image_id = row["FaceID"]
-            if registered_image_id:
-                registered_image = download_image_from_drive(registered_image_id)
-                if registered_image is None:
-                    st.error(f"登録画像 ({registered_image_id}) のダウンロードに失敗しました。")
-                    continue  # 次のユーザーへ
+        # 登録画像の特徴量は FaceID が変わったものだけ計算し直す
+        store = get_face_descriptor_store()
+        store.sync([user["FaceID"] for user in users.values()])
 
-                similarity = face_recognition(uploaded_image, registered_image)
-                if similarity is None:
-                    st.error("顔認識処理でエラーが発生しました。")
-                    continue # 次のユーザーへ
+        # ログイン時に計算するのは撮影画像の特徴量のみ
+        uploaded_descriptors = compute_face_descriptors(uploaded_image.getvalue(), require_face=True)
+        if uploaded_descriptors is None:
+            st.error("顔を検出できませんでした。カメラに顔が正面から写るように撮影してください。")
+            return None
 
-                if similarity > 1:
-                    return row["Email"]  # 認証成功時にEmailを返す
+        user_face_ids = tuple(
+            (email, user["FaceID"]) for email, user in users.items() if user["FaceID"]
+        )
+        matcher = get_face_matcher(user_face_ids, store.version)
+        candidates = matcher.match(uploaded_descriptors, top_k=FACE_MATCH_TOP_K)
+
+        # 最もスコアの高い候補がしきい値を超えていれば認証成功
+        if candidates and candidates[0][1] >= FACE_MATCH_THRESHOLD:
+            return candidates[0][0]  # 認証成功時にEmailを返す
         return None  # 認証失敗時にNoneを返す
 
     except Exception as e:
@@ -292,19 +1983,10 @@ def authenticate_face(uploaded_image):
         st.error(f"Clearphotoを押して再度顔を認証してみてください")
         return None
 
-@st.cache_data(ttl=60)  # API呼び出しを減らす
 def load_customers():
     try:
         with st.spinner("顧客情報を読み込み中..."):  # ローディングインジケーター
-            sheet = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_CUSTOMERS_SHEET_NAME)
-            data = sheet.get_all_records()
-            df = pd.DataFrame(data)
-
-            # 電話番号を文字列型に変換
-            if "電話番号" in df.columns:
-                df["電話番号"] = df["電話番号"].astype(str)
-
-            return df
+            return load_database_snapshot()["customers"].copy()
     except gspread.exceptions.WorksheetNotFound:
         st.error(f"シート '{GOOGLE_CUSTOMERS_SHEET_NAME}' が見つかりません。")
         return pd.DataFrame()  # 空の DataFrame を返す
@@ -313,95 +1995,86 @@ def load_customers():
         return pd.DataFrame()
 
 def load_treatments():
-    sheet = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_TREATMENTS_SHEET_NAME)
-    data = sheet.get_all_records()
-    return pd.DataFrame(data)
+    return get_synced_replica().read_frame("treatments")
 
 def save_customer(customer_data):
     try:
-        with st.spinner("顧客情報を保存中..."): # ローディングインジケーター
-            sheet = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_CUSTOMERS_SHEET_NAME)
-            sheet.append_row(customer_data)
-            st.success(f"✅ 顧客情報を保存しました")
-            return True
+        row, record_id = build_row("customers", customer_data)
+        # シートへは書き込みキュー経由で送り、レプリカにはすぐ反映する
+        track_write("顧客情報の保存", append_record("customers", row, record_id))
+        st.success(f"✅ 顧客情報を保存しました")
+        return True
     except gspread.exceptions.APIError as e:
         st.error(f"顧客情報の保存に失敗しました: {e}")
         return False
     
-def delete_customer(name):
+def delete_customer(customer_id):
     try:
         with st.spinner("顧客情報を削除中..."): # ローディングインジケーター
-            sheet = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_CUSTOMERS_SHEET_NAME)
-            data = sheet.get_all_values()
-            for i, row in enumerate(data):
-                if row and row[0] == name:
-                    sheet.delete_rows(i + 1)
-                break
-            st.success(f"✅ 顧客情報 '{name}' を削除しました。")
+            future = write_record("customers", customer_id)
+            if future is None:
+                st.error("削除する顧客情報が見つかりませんでした。")
+                return
+            track_write("顧客情報の削除", future)
+            st.success(f"✅ 顧客情報を削除しました。")
     except gspread.exceptions.APIError as e:
         st.error(f"顧客情報の削除に失敗しました: {e}")
 
 def save_treatment(treatment_data):
     try:
-        with st.spinner("施術履歴を保存中..."): # ローディングインジケーター
-            sheet = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_TREATMENTS_SHEET_NAME)
-            sheet.append_row(treatment_data)
-            st.success(f"✅ 施術履歴を保存しました。")
+        row, record_id = build_row("treatments", treatment_data)
+        track_write("施術履歴の保存", append_record("treatments", row, record_id))
+        st.success(f"✅ 施術履歴を保存しました。")
+        return record_id
     except gspread.exceptions.APIError as e:
         st.error(f"施術履歴の保存に失敗しました: {e}")
+        return None
 
-def delete_treatment(name):
+def delete_treatment(treatment_id):
     try:
         with st.spinner("施術履歴を削除中..."): # ローディングインジケーター
-            sheet = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_TREATMENTS_SHEET_NAME)
-            data = sheet.get_all_values()
-            for i, row in enumerate(data):
-                if row and row[0] == name:
-                    sheet.delete_rows(i + 1)
-                    break
-            st.success(f"✅ 施術履歴 '{name}' を削除しました。")
+            future = write_record("treatments", treatment_id)
+            if future is None:
+                st.error("削除する施術履歴が見つかりませんでした。")
+                return
+            track_write("施術履歴の削除", future)
+            st.success(f"✅ 施術履歴を削除しました。")
     except gspread.exceptions.APIError as e:
         st.error(f"施術履歴の削除に失敗しました: {e}")
 
 # def update_treatment(row_index, updated_data):
-#     sheet = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_TREATMENTS_SHEET_NAME)
+#     sheet = open_worksheet(GOOGLE_DATABASE_SHEET_NAME, GOOGLE_TREATMENTS_SHEET_NAME)
 #     for col_index, value in enumerate(updated_data, start=1):
 #         sheet.update_cell(row_index + 1, col_index, value)
 
-def update_treatment(df_index, updates):
-    """指定された行の特定のセルを更新する (gspread.update_cellsを使用)。
+def update_treatment(treatment_id, updates):
+    """指定された施術履歴の特定のセルを更新する (書き込みキュー経由で1回のバッチにまとめる)。
 
     Args:
-        df_index (int): 更新する行の DataFrame インデックス (0-based)。
+        treatment_id (str): 更新する施術履歴の ID。
         updates (dict): 更新内容の辞書 {列名: 新しい値}。
     """
     try:
         with st.spinner("施術履歴を更新中..."):
-            sheet = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_TREATMENTS_SHEET_NAME)
-            headers = sheet.row_values(1) # ヘッダー行を取得して列名と列番号をマッピング
-            col_map = {header: i + 1 for i, header in enumerate(headers)} # 列名 -> 列番号 (1-based)
-
-            cells_to_update = []
-            # DataFrame index (0-based) を Google Sheets の行番号 (1-based) に変換 (ヘッダー分 +1, 0-basedを1-basedに+1 => +2)
-            google_sheets_row_index = df_index + 2
+            headers = get_synced_replica().headers("treatments") or [] # レプリカのヘッダーで列名を確認
 
+            cells_to_update = {}
             for col_name, value in updates.items():
-                if col_name in col_map:
-                    col_index = col_map[col_name]
-                    # gspread の update_cells 用に Cell オブジェクトを作成
+                if col_name in headers and col_name != ID_COLUMN:
                     # 値は文字列に変換しておくのが無難 (日付なども)
-                    cells_to_update.append(gspread.Cell(google_sheets_row_index, col_index, str(value)))
+                    cells_to_update[col_name] = str(value)
                 else:
                     # シートに存在しない列名を指定した場合の警告
                     st.warning(f"列名 '{col_name}' がシート '{GOOGLE_TREATMENTS_SHEET_NAME}' に見つかりません。スキップします。")
 
             if cells_to_update:
                 # 複数のセルを一度に更新 (API呼び出し回数を削減)
-                sheet.update_cells(cells_to_update, value_input_option='USER_ENTERED')
+                future = write_record("treatments", treatment_id, cells_to_update)
+                if future is None:
+                    st.error("更新する施術履歴が見つかりませんでした。")
+                    return False
+                track_write("施術履歴の更新", future)
                 st.success("✅ 施術履歴を更新しました！")
-                # キャッシュクリア
-                load_treatments_with_furigana.clear()
-                st.session_state["customer_updated"] = True # 更新フラグ
                 return True # 成功を示す値を返す
             else:
                 st.info("更新対象のデータがありませんでした。")
@@ -414,54 +2087,356 @@ def update_treatment(df_index, updates):
         return False
 
 
-def update_customer(old_name, updated_data):
-  try:
-    with st.spinner("顧客情報を更新中..."): # ローディングインジケーター
-        sheet = client.open(GOOGLE_DATABASE_SHEET_NAME).worksheet(GOOGLE_CUSTOMERS_SHEET_NAME)
-        data = sheet.get_all_values()
-
-        for i, row in enumerate(data):
-            if row and row[0] == old_name:  # 顧客名が一致する行を探す
-                for col_index, value in enumerate(updated_data, start=1):
-                    sheet.update_cell(i + 1, col_index, value)  # セルを更新
-                break
-  except gspread.exceptions.APIError as e:
+def update_customer(customer_id, updated_data):
+    """顧客情報の行を更新する。updated_data は ID 以外の列を先頭から並べたリスト."""
+    try:
+        with st.spinner("顧客情報を更新中..."): # ローディングインジケーター
+            headers = get_synced_replica().headers("customers") or []
+            updates = {header: value for header, value in zip(headers, updated_data) if header != ID_COLUMN}
+            # 複数のセルを一度に更新 (API呼び出し回数を削減)
+            future = write_record("customers", customer_id, updates)
+            if future is None:
+                st.error("更新する顧客情報が見つかりませんでした。")
+                return False
+            track_write("顧客情報の更新", future)
+            return True
+    except gspread.exceptions.APIError as e:
         st.error(f"顧客情報の更新に失敗しました: {e}")
+        return False
 
-# Google Sheets API: 複数のセルをまとめて更新 (バッチリクエスト)
-def update_cells_batch(spreadsheet_id, sheet_name, updates):
-    """Google Sheets API を使用して複数のセルをまとめて更新 (バッチリクエスト).
+# 顧客検索: 正規化キーの前方一致インデックス
+CUSTOMER_SUGGESTION_LIMIT = 20  # タイプアヘッドで表示する候補の最大数
 
-    Args:
-        spreadsheet_id (str): スプレッドシートのID
-        sheet_name (str): シート名
-        updates (list of dict): 更新内容のリスト。各辞書はセル範囲と新しい値を含む。
-            例: [{'range': 'A1:A2', 'values': [[1], [2]]}, {'range': 'B1', 'values': [['test']]}]
+class CustomerPrefixIndex:
+    """顧客名・フリガナの正規化キーをソートした配列に持つ前方一致インデックス.
+
+    姓・名で分けて入力されている場合に名だけでも引けるよう、空白で区切った各部分も登録する。
+    検索は二分探索でキーの範囲を求めるだけなので、顧客数が多くても入力のたびに即座に返せる。
     """
-    try:
-        service = build('sheets', 'v4', credentials=creds)  # sheets API v4 を使用
 
-        body = {'value_input_option': 'USER_ENTERED',  # 'USER_ENTERED'は数式を評価, 'RAW'はそのまま
-                'data': updates}  # dataに更新内容のリストを設定
+    def __init__(self, df_customers):
+        entries = set()
+        for position, (name, furigana) in enumerate(zip(df_customers["顧客名"], df_customers["フリガナ"])):
+            for text in (name, furigana):
+                text = str(text)
+                for part in [text, *text.split()]:
+                    key = normalize_search_key(part)
+                    if key:
+                        entries.add((key, position))
+        entries = sorted(entries)
+        self.keys = [key for key, _ in entries]
+        self.positions = [position for _, position in entries]
+
+    def search(self, query, limit=None):
+        """正規化キーが query で始まる顧客の位置を、キーの順に重複なく返す."""
+        key = normalize_search_key(query)
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_left(self.keys, key + "\U0010ffff")
+        positions = list(dict.fromkeys(self.positions[start:end]))
+        return positions[:limit] if limit else positions
+
+@st.cache_resource(max_entries=1)  # 顧客データのバージョンが変わったときだけ作り直す
+def get_customer_prefix_index(data_version, _df_customers):
+    return CustomerPrefixIndex(_df_customers)
+
+def search_customers(df_customers, query, limit=None, substring=True):
+    """顧客名・フリガナで顧客を検索し、該当する行の位置を返す.
+
+    前方一致 (インデックス) の結果を先に、substring なら続けて正規化キーの部分一致の
+    結果を返す。タイプアヘッドの候補は substring=False で前方一致だけを引く。
+    """
+    if df_customers.empty:
+        return []
+    key = normalize_search_key(query)
+    if not key:
+        return list(range(len(df_customers)))[:limit]
+    index = get_customer_prefix_index(df_customers.attrs.get("data_version"), df_customers)
+    positions = index.search(query)
+    if not substring or (limit and len(positions) >= limit):
+        return positions[:limit] if limit else positions
+    contains = np.flatnonzero(df_customers["検索キー"].str.contains(key, regex=False).to_numpy(dtype=bool, na_value=False))
+    positions = list(dict.fromkeys([*positions, *contains.tolist()]))
+    return positions[:limit] if limit else positions
+
+# 電話番号検索: 数字だけに正規化した番号の完全一致・下4桁インデックス
+def normalize_phone_digits(phone_number):
+    """電話番号を数字だけにする (全角数字・ハイフン・空白・括弧の違いを吸収)."""
+    return re.sub(r"\D", "", unicodedata.normalize("NFKC", str(phone_number)))
+
+PHONE_LOOKUP_MIN_DIGITS = 4  # 電話番号はこの桁数以上入力されてから引く (下4桁での検索)
+
+class PhoneIndex:
+    """顧客の電話番号 (数字のみ) → 行の位置の辞書。完全一致と下4桁で引ける."""
+
+    def __init__(self, df_customers):
+        self.digits = df_customers["電話番号"].map(normalize_phone_digits).tolist()
+        self.exact = defaultdict(list)
+        self.last4 = defaultdict(list)
+        for position, digits in enumerate(self.digits):
+            if digits:
+                self.exact[digits].append(position)
+                self.last4[digits[-4:]].append(position)
+
+    def lookup(self, phone_number):
+        """完全一致する顧客の位置。なければ末尾が一致する顧客 (4桁以上の入力のみ) の位置."""
+        digits = normalize_phone_digits(phone_number)
+        if len(digits) < PHONE_LOOKUP_MIN_DIGITS:
+            return []
+        if digits in self.exact:
+            return list(self.exact[digits])
+        return [p for p in self.last4.get(digits[-4:], []) if self.digits[p].endswith(digits)]
+
+@st.cache_resource(max_entries=1)  # 顧客データのバージョンが変わったときだけ作り直す
+def get_phone_index(data_version, _df_customers):
+    return PhoneIndex(_df_customers)
+
+def lookup_customers_by_phone(df_customers, phone_number):
+    """電話番号 (全体または下4桁以上) から該当する顧客の行を返す."""
+    if df_customers.empty or "電話番号" not in df_customers.columns:
+        return df_customers.iloc[0:0]
+    index = get_phone_index(df_customers.attrs.get("data_version"), df_customers)
+    return df_customers.iloc[index.lookup(phone_number)]
+
+# 施術履歴の検索: 文字 n-gram の転置インデックス
+TREATMENT_SEARCH_COLUMNS = ["顧客名", "フリガナ", "施術内容", "施術メモ", "日付", date_text_column("日付")]  # 日付は入力値でも引ける
+
+def _ngrams(text):
+    """文字のユニグラムとバイグラムの集合 (日本語は単語の区切りがないので文字単位で切る)."""
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+class TreatmentSearchIndex:
+    """施術履歴の AND 検索用の転置インデックス (n-gram → 行の位置の配列).
+
+    各行の検索対象列を区切り文字でつないだ小文字の文字列から n-gram を作る。
+    キーワードごとに出現行の少ない n-gram の転置リストを積集合し、3文字以上の
+    キーワードは候補行の文字列で部分一致を確かめる。データのバージョンが変わっても
+    既存の行が同じなら追加された行だけを索引に加える。プロセス内で共有するので、
+    索引を df に合わせる処理と検索は1つのロックの中で行う (search)。
+    """
 
-        request = service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=body)
-        response = request.execute()
-        print(f"更新結果: {response}")
-        return response
-    except errors.HttpError as error:
-        print(f"An error occurred: {error}")
+    def __init__(self, columns):
+        self.columns = columns
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.texts = []
+        self.postings = defaultdict(lambda: array("I"))
+        self.data_version = None
+
+    def _texts(self, df):
+        # 列ごとのベクトル演算で文字列を作る (行ごとの Python ループを避ける)
+        texts = pd.Series("", index=df.index)
+        for column in self.columns:
+            if column in df.columns:
+                texts = texts + "\x00" + column_text(df[column]).str.lower()
+        return texts.tolist()
+
+    def _sync(self, df):
+        """df (施術履歴) の内容にインデックスを合わせる (self.lock を持って呼ぶ)."""
+        version = df.attrs.get("data_version")
+        if version is not None and version == self.data_version and len(df) == len(self.texts):
+            return
+        texts = self._texts(df)
+        indexed = len(self.texts)
+        if len(texts) < indexed or texts[:indexed] != self.texts:
+            self._reset()  # 追記以外の変更 (編集・削除) は作り直す
+            indexed = 0
+        for position, text in enumerate(texts[indexed:], start=indexed):
+            for gram in _ngrams(text):
+                self.postings[gram].append(position)
+        self.texts.extend(texts[indexed:])
+        self.data_version = version
+
+    def search(self, df, keywords):
+        """df (施術履歴) のうち、すべてのキーワードを含む行の位置 (昇順) を返す (大文字・小文字は区別しない).
+
+        他のセッションが別のバージョンの df で検索しても混ざらないよう、索引を df に
+        合わせてから検索し終わるまでロックを持つ。
+        """
+        with self.lock:
+            self._sync(df)
+            if not keywords:
+                return list(range(len(self.texts)))
+            result = None
+            for keyword in keywords:
+                keyword = keyword.lower()
+                grams = [keyword] if len(keyword) <= 2 else [keyword[i:i + 2] for i in range(len(keyword) - 1)]
+                postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+                # 出現行の最も少ない2つの n-gram で候補を絞る
+                candidates = set(postings[0])
+                if len(postings) > 1:
+                    candidates &= set(postings[1])
+                if result is not None:
+                    candidates &= result
+                if len(keyword) > 2:
+                    candidates = {p for p in candidates if keyword in self.texts[p]}
+                result = candidates
+                if not result:
+                    break
+            return sorted(result or ())
+
+@st.cache_resource  # プロセス内で共有し、データが変わったときだけ更新する
+def get_treatment_search_index():
+    return TreatmentSearchIndex(TREATMENT_SEARCH_COLUMNS)
+
+# 顧客ごとの来店履歴: データのバージョンごとに一度だけ集計する
+class TreatmentGroups:
+    """顧客名 → 来店履歴 (日付の新しい順の行の位置) と来店の集計 (最終来店日・回数・平均間隔)."""
+
+    def __init__(self, df_treatments):
+        dates = df_treatments["日付"]  # 読み込み時に datetime64 にしてある
+        # 日付の新しい順 (不正な日付は最後) に並べた行の位置を顧客名でまとめる
+        order = dates.reset_index(drop=True).sort_values(ascending=False, na_position="last", kind="stable").index.to_numpy()
+        names = df_treatments["顧客名"].to_numpy()[order]
+        self.visits = {name: order[positions] for name, positions in pd.Series(names).groupby(names, sort=False).indices.items()}
+
+        stats = dates.groupby(df_treatments["顧客名"].to_numpy()).agg(["max", "min", "count"])
+        intervals = (stats["max"] - stats["min"]).dt.days / (stats["count"] - 1).where(stats["count"] > 1)
+        self.summaries = {
+            name: {
+                "last_visit": last_visit,
+                "visit_count": len(self.visits[name]),
+                "average_interval_days": None if pd.isna(interval) else float(interval),
+            }
+            for name, last_visit, interval in zip(stats.index, stats["max"], intervals)
+        }
+
+    def visit_positions(self, customer_name):
+        """顧客の施術履歴の行の位置 (日付の新しい順)."""
+        return self.visits.get(customer_name, np.array([], dtype=np.intp))
+
+    def summary(self, customer_name):
+        return self.summaries.get(customer_name, {"last_visit": pd.NaT, "visit_count": 0, "average_interval_days": None})
+
+@st.cache_resource(max_entries=1)  # 施術履歴のバージョンが変わったときだけ作り直す
+def get_treatment_groups(data_version, _df_treatments):
+    return TreatmentGroups(_df_treatments)
+
+@st.cache_resource(max_entries=1)  # 顧客データのバージョンが変わったときだけ作り直す
+def get_customer_positions(data_version, _df_customers):
+    """顧客名 → 行の位置 (同名の顧客がいれば最初の行)."""
+    return {name: position for position, name in reversed(list(enumerate(_df_customers["顧客名"])))}
+
+# 施術履歴の選択: 顧客 → その顧客の来店 (ページ送り) の順に絞り込む
+TREATMENT_SELECTOR_PAGE_SIZE = 20  # 1ページに表示する施術履歴の件数
+TREATMENT_SELECTOR_CUSTOMER_LIMIT = 50  # 顧客の選択肢に表示する最大数
+
+def treatment_labels(df_treatments):
+    """施術履歴の選択肢の表示 (顧客名 | 施術内容 | 日付) を列のベクトル演算で作る."""
+    return (
+        column_text(df_treatments["顧客名"])
+        + " | " + column_text(df_treatments["施術内容"])
+        + " | " + date_text(df_treatments, "日付")
+    )
+
+def select_treatment(df_treatments, key, label):
+    """顧客を選んでから、その顧客の施術履歴を1ページずつ表示して1件選ばせる.
+
+    ブラウザに送る選択肢は顧客の候補 (最大 TREATMENT_SELECTOR_CUSTOMER_LIMIT 件) と
+    施術履歴の1ページ分だけ。選ばれた行 (Series) を返す。未選択なら None。
+    """
+    groups = get_treatment_groups(df_treatments.attrs.get("data_version"), df_treatments).visits
+    query = st.text_input("👤 顧客名で絞り込み", key=f"{key}_customer_query")
+    if query:
+        df_customers = load_customers()
+        names = df_customers["顧客名"].iloc[search_customers(df_customers, query)]
+        names = [name for name in names if name in groups]
+    else:
+        # 入力がなければ最近の施術履歴がある顧客から順に
+        names = df_treatments["顧客名"].iloc[::-1].drop_duplicates().tolist()
+    names = names[:TREATMENT_SELECTOR_CUSTOMER_LIMIT]
+    if not names:
+        st.info("該当する顧客の施術履歴がありません。")
         return None
+    customer_name = st.selectbox("👤 顧客を選択", names, key=f"{key}_customer")
+
+    visits = df_treatments.iloc[groups[customer_name]]  # 日付の新しい順に並べ済み
+    page_count = -(-len(visits) // TREATMENT_SELECTOR_PAGE_SIZE)
+    page = 1
+    if page_count > 1:
+        page = st.number_input(
+            "ページ", min_value=1, max_value=page_count, value=1, step=1, key=f"{key}_page_{customer_name}",
+        )
+        st.caption(f"全 {page_count} ページ / {len(visits)} 件")
+    start = (page - 1) * TREATMENT_SELECTOR_PAGE_SIZE
+    window = visits.iloc[start:start + TREATMENT_SELECTOR_PAGE_SIZE]
+
+    # 値は ID、表示は候補の文字列。選ばれた ID から辞書で行を引く
+    labels = dict(zip(window[ID_COLUMN], treatment_labels(window)))
+    rows = dict(zip(window[ID_COLUMN], window.index))
+    selected_id = st.selectbox(label, list(labels), format_func=labels.get, key=f"{key}_select")
+    if selected_id is None:
+        return None
+    return df_treatments.loc[rows[selected_id]]
+
+# 大きな表: サーバー側で並べ替え、選んだ列と1ページ分の行だけをブラウザに送る
+TABLE_PAGE_SIZES = [20, 50, 100, 200]  # 1ページの表示件数の選択肢
+TABLE_PAGE_SIZE = int(config.get("table_page_size", 50))  # 表示件数の初期値
+TABLE_NO_SORT = "(シートの順)"
+
+def sort_positions(series, ascending):
+    """列の値で並べ替えた行の位置 (空欄・不正な日付は最後)."""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        series = series.astype(TEXT_DTYPE)  # カテゴリの登録順ではなく値の順に並べる
+    return series.reset_index(drop=True).sort_values(ascending=ascending, na_position="last", kind="stable").index.to_numpy()
+
+def paged_dataframe(df, key, hidden_columns=(), column_config=None):
+    """df を1ページずつ st.dataframe で表示する.
+
+    並べ替え・表示件数・ページ・表示する列はウィジェット (キーは key から作る) で選ぶ。
+    絞り込みは呼び出し側で済ませた df を渡す。毎回の再実行でブラウザに送るのは
+    選んだ列の1ページ分だけなので、行が増えても表示の重さは変わらない。
+    """
+    columns = [column for column in df.columns if column not in hidden_columns]
+    col1, col2, col3, col4 = st.columns([3, 2, 2, 2])
+    with col1:
+        sort_column = st.selectbox("並べ替え", [TABLE_NO_SORT, *columns], key=f"{key}_sort")
+    with col2:
+        descending = st.toggle("降順", key=f"{key}_descending")
+    with col3:
+        page_size = st.selectbox("表示件数", TABLE_PAGE_SIZES, key=f"{key}_page_size",
+                                 index=TABLE_PAGE_SIZES.index(TABLE_PAGE_SIZE) if TABLE_PAGE_SIZE in TABLE_PAGE_SIZES else 1)
+    page_count = max(1, -(-len(df) // page_size))
+    page_key = f"{key}_page"
+    if st.session_state.get(page_key, 1) > page_count:
+        st.session_state[page_key] = page_count  # 絞り込みで件数が減ったら最後のページに
+    with col4:
+        page = st.number_input("ページ", min_value=1, max_value=page_count, step=1, key=page_key)
+    with st.popover("🧩 表示する列"):
+        visible = st.multiselect("表示する列", columns, default=columns, key=f"{key}_columns",
+                                 label_visibility="collapsed")
+
+    # 並べ替えは行の位置で行い、表示するページの行だけを取り出す
+    start = (page - 1) * page_size
+    if sort_column == TABLE_NO_SORT:
+        window = df.iloc[start:start + page_size]
+    else:
+        window = df.iloc[sort_positions(df[sort_column], not descending)[start:start + page_size]]
+    window = window[visible or columns]
+    # category の列はカテゴリ全体が一緒に送られるので、ページ分の文字列にしてから渡す
+    window = window.astype({column: TEXT_DTYPE for column in window.columns
+                            if isinstance(window[column].dtype, pd.CategoricalDtype)})
+    st.dataframe(window, column_config=column_config, hide_index=True, use_container_width=True)
+    st.caption(f"全 {len(df)} 件中 {min(start + 1, len(df))}〜{min(start + page_size, len(df))} 件目 "
+               f"(ページ {page} / {page_count})")
 
 def customer_details_view(customer_name):
     """顧客詳細ビューを表示する関数"""
     df_customers = load_customers()
     df_treatments = load_treatments_with_furigana()
     
-    # 選択された顧客の情報を取得
-    customer_info = df_customers[df_customers["顧客名"] == customer_name].iloc[0]
+    # 選択された顧客の情報を取得 (顧客名 → 行の位置の辞書で引く)
+    customer_positions = get_customer_positions(df_customers.attrs.get("data_version"), df_customers)
+    customer_info = df_customers.iloc[customer_positions[customer_name]]
     
-    # 顧客の施術履歴を取得
-    customer_treatments = df_treatments[df_treatments["顧客名"] == customer_name]
+    # 顧客の施術履歴と来店の集計を取得 (集計済みの辞書から引くだけ)
+    if df_treatments.empty:
+        customer_treatments, summary = df_treatments, {"last_visit": pd.NaT, "visit_count": 0, "average_interval_days": None}
+    else:
+        groups = get_treatment_groups(df_treatments.attrs.get("data_version"), df_treatments)
+        customer_treatments = df_treatments.iloc[groups.visit_positions(customer_name)]  # 日付の新しい順
+        summary = groups.summary(customer_name)
     
     # カラムレイアウト
     col1, col2 = st.columns([1, 2])
@@ -472,11 +2447,13 @@ def customer_details_view(customer_name):
         
         # 基本情報テーブル
         info_data = {
-            "項目": ["電話番号", "住所", "最終来店日","メモ"],
+            "項目": ["電話番号", "住所", "最終来店日", "来店回数", "平均来店間隔", "メモ"],
             "内容": [
                 customer_info["電話番号"],
                 customer_info["住所"],
-                customer_treatments["日付"].max() if "日付" in customer_treatments.columns and not customer_treatments.empty else "なし",
+                summary["last_visit"].strftime("%Y-%m-%d") if pd.notna(summary["last_visit"]) else "なし",
+                f"{summary['visit_count']} 回",
+                f"{summary['average_interval_days']:.0f} 日" if summary["average_interval_days"] is not None else "なし",
                 customer_info["メモ"] if not pd.isna(customer_info["メモ"]) else "なし"
                               
             ]
@@ -489,12 +2466,25 @@ def customer_details_view(customer_name):
             st.info("施術履歴がありません")
         else:
             # 施術履歴をタイムライン表示
-            for _, treatment in customer_treatments.sort_values("日付", ascending=False).iterrows():
-                with st.expander(f"{treatment['日付']} - {treatment['施術内容']}"):
-                    # 写真がある場合は表示
+            dates = date_text(customer_treatments, "日付")
+            for treatment, date in zip(customer_treatments.to_dict("records"), dates):
+                with st.expander(f"{date} - {treatment['施術内容']}"):
+                    # 写真がある場合はサムネイルを表示する。閉じた expander の中身も再実行のたびに
+                    # 実行されるので、ローカルにないサムネイルと原寸は操作したときだけ Drive から読み込む
                     if not pd.isna(treatment["写真"]) and treatment["写真"]:
                         try:
-                            st.markdown(f"[![施術写真]({treatment['写真']})]({treatment['写真']})")
+                            thumbnail = get_treatment_thumbnail(treatment["写真"], fetch=False)
+                            if thumbnail is None and st.toggle("📷 写真を表示", key=f"thumbnail_{treatment[ID_COLUMN]}"):
+                                thumbnail = get_treatment_thumbnail(treatment["写真"])
+                                if not thumbnail:
+                                    st.warning("写真を表示できません")
+                            if thumbnail:
+                                st.image(thumbnail, width=THUMBNAIL_WIDTH)
+                            if st.checkbox("🔍 原寸で表示", key=f"full_photo_{treatment[ID_COLUMN]}"):
+                                original = download_image_from_drive(drive_file_id(treatment["写真"]))
+                                if original is not None:
+                                    st.image(original.getvalue())
+                            st.markdown(f"[Google Drive で開く]({treatment['写真']})")
                         except:
                             st.warning("写真を表示できません")
                     
@@ -519,8 +2509,49 @@ def customer_details_view(customer_name):
                     #             st.session_state["confirm_delete"] = (treatment["日付"], treatment["施術内容"])
                     #             st.warning("もう一度クリックすると削除されます")    
 
+def show_startup_report():
+    """サイドバーに起動時間レポート (コンポーネントごとの初回の読み込み・接続時間) を表示する."""
+    rows = get_startup_report().rows()
+    with st.sidebar.expander("⏱️ 起動時間レポート"):
+        if not rows:
+            st.caption("まだ記録がありません。")
+            return
+        st.dataframe(
+            pd.DataFrame([(name, round(seconds * 1000, 1)) for name, seconds in rows], columns=["コンポーネント", "ミリ秒"]),
+            hide_index=True, use_container_width=True,
+        )
+
+def show_api_call_panel():
+    """管理用: Google API 呼び出しの集計 (この再実行・このセッション累計・バックグラウンド) をサイドバーに表示する."""
+    recorder = get_api_call_recorder()
+    ctx = get_script_run_ctx(suppress_warning=True)
+    session_id = ctx.session_id if ctx else BACKGROUND_SESSION
+    scopes = [("この再実行", session_id, "current"), ("このセッション累計", session_id, "total"),
+              ("バックグラウンド累計", BACKGROUND_SESSION, "total")]
+    with st.sidebar.expander("📊 Google API 呼び出し"):
+        export = []
+        for title, scope_session, scope in scopes:
+            rows = recorder.summary(scope_session, scope)
+            st.markdown(f"**{title}**: {sum(row[1] for row in rows)} 回")
+            if rows:
+                st.dataframe(
+                    pd.DataFrame([(label, calls, round(nbytes / 1024, 1), round(seconds * 1000, 1), errors)
+                                  for label, calls, nbytes, seconds, errors in rows],
+                                 columns=["呼び出し", "回数", "KB", "ミリ秒", "エラー"]),
+                    hide_index=True, use_container_width=True,
+                )
+            export.extend((title, *row) for row in rows)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["範囲", "呼び出し", "回数", "バイト", "秒", "エラー"])
+        writer.writerows(export)
+        st.download_button("📥 CSV をダウンロード", buffer.getvalue().encode("utf-8-sig"),
+                           file_name="api_calls.csv", mime="text/csv")
+
 def main():
     st.set_page_config(page_title="美容院カルテ管理", layout="wide")
+    # この再実行で行う Google API 呼び出しの集計を始める
+    get_api_call_recorder().begin_rerun()
 
     # CSSの追加
     st.markdown("""
@@ -547,13 +2578,14 @@ def main():
     if "authenticated" not in st.session_state:
         st.session_state.authenticated = False
 
-        # 更新フラグが立っていれば、キャッシュをクリア
-    if "customer_updated" in st.session_state and st.session_state["customer_updated"]:
-        # キャッシュをクリア
-        load_customers.clear()
-        load_treatments_with_furigana.clear()
-        # フラグをリセット
-        st.session_state["customer_updated"] = False
+    # 顧客・施術履歴のローカルレプリカをバックグラウンドで同期
+    start_replica_sync()
+    # 書き込みキューの失敗・送信待ちを表示
+    show_write_status()
+    # 写真アップロードの進捗・結果を表示
+    show_upload_status()
+    if SHOW_DIAGNOSTICS:
+        show_startup_report()
 
     if not st.session_state.authenticated:
         st.subheader(" ログインフォーム")
@@ -591,9 +2623,10 @@ def main():
         else:
             search_query = st.text_input("🔍 検索（顧客名 または フリガナ）", key="customer_search")
             if search_query:
-                df = df[df["顧客名"].str.contains(search_query, na=False, case=False) |
-                        df["フリガナ"].str.contains(search_query, na=False, case=False)]
-            st.dataframe(df, use_container_width=True,hide_index=True)
+                # ひらがな・半角カナ・全角/半角の違いを無視して検索 (前方一致を先に表示)
+                df = df.iloc[search_customers(df, search_query)]
+            # 1ページ分の行と選んだ列だけを送る
+            paged_dataframe(df, "customer_table", hidden_columns=[ID_COLUMN, "検索キー"])
 
         with st.expander("➕ 顧客情報の追加"):
             col1, col2 = st.columns(2)
@@ -620,16 +2653,17 @@ def main():
                 if name:
                     save_customer([name, furigana, str(phone), address, note])
                     st.success(f"✅ {name} ({furigana}) を追加しました")
-                    st.session_state["customer_updated"] = True  # 更新フラグをセット
                     st.rerun()
         with st.expander("✏️ 顧客情報の編集"):
             df_customers = load_customers()
 
             if not df_customers.empty:
-                selected_name = st.selectbox("編集する顧客を選択", df_customers["顧客名"].tolist())
+                customer_names = dict(zip(df_customers[ID_COLUMN], df_customers["顧客名"]))
+                selected_id = st.selectbox("編集する顧客を選択", list(customer_names), format_func=customer_names.get)
 
                 # 選択した顧客の情報を取得
-                selected_customer = df_customers[df_customers["顧客名"] == selected_name].iloc[0]
+                selected_customer = df_customers[df_customers[ID_COLUMN] == selected_id].iloc[0]
+                selected_name = selected_customer["顧客名"]
 
                 # フォームの初期値（key を追加）
                 new_name = st.text_input("👤 顧客名", selected_customer["顧客名"], key="edit_name")
@@ -639,30 +2673,19 @@ def main():
                 new_note = st.text_area("📝 メモ", selected_customer["メモ"], key="edit_note")
 
                 if st.button("更新"):
-                  # バッチアップデートの準備
-                  spreadsheet_id = client.open(GOOGLE_DATABASE_SHEET_NAME).id
-                  sheet_name = GOOGLE_CUSTOMERS_SHEET_NAME
-                  updates = []
-
-                  row_index = df_customers[df_customers["顧客名"] == selected_name].index[0] + 2 # 1始まりなので+2
-                  updates.append({'range': f'{sheet_name}!A{row_index}', 'values': [[new_name]]})  # 顧客名
-                  updates.append({'range': f'{sheet_name}!B{row_index}', 'values': [[new_furigana]]})  # フリガナ
-                  updates.append({'range': f'{sheet_name}!C{row_index}', 'values': [[new_phone]]})  # 電話番号
-                  updates.append({'range': f'{sheet_name}!D{row_index}', 'values': [[new_address]]})  # 住所
-                  updates.append({'range': f'{sheet_name}!E{row_index}', 'values': [[new_note]]})   # メモ
-                  update_cells_batch(spreadsheet_id, sheet_name, updates)
-                  st.success(f"✅ {selected_name} ({new_furigana}) の情報を更新しました")
-                  st.session_state["customer_updated"] = True
-                  st.rerun()
+                  # ID から行を特定して1回のリクエストで更新
+                  if update_customer(selected_id, [new_name, new_furigana, new_phone, new_address, new_note]):
+                      st.success(f"✅ {selected_name} ({new_furigana}) の情報を更新しました")
+                      st.rerun()
 
         # 顧客情報の削除
         with st.expander("❌ 顧客情報の削除"):
-            delete_name = st.selectbox("削除する顧客を選択", df['顧客名'] if not df.empty else [])
+            delete_names = dict(zip(df[ID_COLUMN], df["顧客名"])) if not df.empty else {}
+            delete_id = st.selectbox("削除する顧客を選択", list(delete_names), format_func=delete_names.get)
             if st.button("削除", use_container_width=True):
-                if delete_name:
-                    delete_customer(delete_name)
-                    st.success(f"✅ {delete_name} を削除しました")
-                    st.session_state["customer_updated"] = True  # 更新フラグをセット
+                if delete_id:
+                    delete_customer(delete_id)
+                    st.success(f"✅ {delete_names[delete_id]} を削除しました")
                     st.rerun()
     with tab2:
         st.subheader("📜 施術履歴一覧")
@@ -673,36 +2696,29 @@ def main():
         else:
             df_customers = load_customers()
 
-            # 日付カラムを適切なデータ型に変換
-            if "施術日" in df_treatments.columns:
-                df_treatments["施術日"] = pd.to_datetime(df_treatments["施術日"], errors="coerce").dt.strftime("%Y-%m-%d")
-
             # 🔍 検索機能（AND検索 & 日付検索対応）
             search_query = st.text_input("🔍 検索（スペース区切りでAND検索、日付も可）",key="treatment_search")
 
             if search_query:
-                search_columns = ["顧客名","フリガナ", "施術内容", "施術メモ", "日付"]  # 🔥 日付も検索対象に追加
-                df_treatments = df_treatments.dropna(subset=search_columns)  # NaNを除去
-
                 # スペース区切りでキーワードをリスト化
                 keywords = search_query.split()
 
-                # すべてのキーワードを含む行のみ抽出（AND検索）
-                for keyword in keywords:
-                    df_treatments = df_treatments[
-                        df_treatments[search_columns].apply(lambda row: row.astype(str).str.contains(keyword, case=False, na=False).any(), axis=1)
-                    ]
+                # すべてのキーワードを含む行のみ抽出（AND検索、🔥 日付も検索対象）
+                # 転置インデックスはデータが変わったときだけ更新される
+                df_treatments = df_treatments.iloc[get_treatment_search_index().search(df_treatments, keywords)]
 
             # DataFrame のカラム名を変更（写真 → 画像URL）
             df_treatments.rename(columns={"写真": "画像URL"}, inplace=True)
 
-            # StreamlitのDataFrame表示でリンクを設定
-            st.dataframe(
-                df_treatments,
+            # StreamlitのDataFrame表示でリンクを設定 (1ページ分の行と選んだ列だけを送る)
+            paged_dataframe(
+                df_treatments, "treatment_table",
+                # ID は表示しない。日付の入力値は日付として読めない行があるときだけ表示する
+                hidden_columns=[ID_COLUMN] + ([] if has_unparsed_dates(df_treatments, "日付") else [date_text_column("日付")]),
                 column_config={
                     "画像URL": st.column_config.LinkColumn("📸 施術写真"),
+                    "日付": st.column_config.DateColumn("日付", format="YYYY-MM-DD"),
                 },
-                use_container_width=True
             )
 
         with st.expander("➕ 施術履歴の追加"):
@@ -714,20 +2730,12 @@ def main():
             photo = st.file_uploader("🖼️ 写真アップロード（Google Drive）", type=["jpg", "jpeg", "png"])
 
             if st.button("施術履歴を追加"):
-                file_url = None
-                if photo:
-                    st.image(photo, caption="アップロード画像", width=200)
-                    try:
-                        with st.spinner("画像をアップロード中..."):  # ローディングインジケーター
-                            file_url = upload_to_drive(photo)
-                            st.success("✅ アップロード完了！")
-                    except Exception as e:
-                        st.error(f"❌ 画像のアップロードに失敗しました: {e}")
-
                 if customer_name and treatment:
-                    save_treatment([customer_name, treatment, str(date), file_url, note])
+                    # 行はすぐに保存し、写真はバックグラウンドでアップロードしてから URL を書き込む
+                    treatment_id = save_treatment([customer_name, treatment, str(date), None, note])
+                    if photo and treatment_id:
+                        start_photo_upload(photo, treatment_id, f"{customer_name} ({date})")
                     st.success(f"✅ {customer_name} の施術履歴を追加しました")
-                    st.session_state["customer_updated"] = True  # 更新フラグをセット
                     st.rerun()
 
         # with st.expander("✏️ 施術履歴の編集"):
@@ -758,86 +2766,53 @@ def main():
             df_treatments = load_treatments_with_furigana() # 最新のデータを読み込む
 
             if not df_treatments.empty:
-                # 日付列を文字列に整形（選択肢表示用、エラー処理追加）
-                if "日付" in df_treatments.columns:
-                    try:
-                        df_treatments["日付_str"] = pd.to_datetime(df_treatments["日付"], errors='coerce').dt.strftime('%Y-%m-%d')
-                        # NaT (不正な日付) を空文字に置換
-                        df_treatments["日付_str"] = df_treatments["日付_str"].fillna("")
-                    except Exception as e:
-                        st.warning(f"日付のフォーマット中にエラー: {e}")
-                        df_treatments["日付_str"] = "" # エラー時は空文字
-                else:
-                    df_treatments["日付_str"] = "" # 日付列がない場合
-
-                # 編集用の選択肢を作成（顧客名 | 施術内容 | 日付）
-                # 欠損値があるとエラーになるため、fillna('') で空文字に置換
-                df_treatments["編集候補"] = df_treatments.apply(
-                    lambda row: f"{row.get('顧客名','')} | {row.get('施術内容','')} | {row.get('日付_str','')}", axis=1
-                )
-
-                # 施術履歴を選択 (keyを追加して状態保持)
-                edit_option = st.selectbox(
-                    "✏️ 編集する施術履歴を選択",
-                    df_treatments["編集候補"].tolist(),
-                    key="edit_treatment_select" # Selectbox用のキー
-                )
+                # 顧客 → 施術履歴の順に選ぶ (選択肢は1ページ分だけ作る)
+                selected_row = select_treatment(df_treatments, "edit_treatment", "✏️ 編集する施術履歴を選択")
 
-                if edit_option:
+                if selected_row is not None:
                     try:
-                        # 選択されたデータを取得 (候補文字列からDataFrameの行を特定)
-                        # iloc[0] を使うために、該当行が必ず1つ存在すると仮定。エラー処理を追加するとより安全。
-                        selected_row_df = df_treatments[df_treatments["編集候補"] == edit_option]
-
-                        if not selected_row_df.empty:
-                            selected_row = selected_row_df.iloc[0]
-                            # DataFrame のインデックス (0-based) を取得
-                            df_index = selected_row.name
-
-                            # --- 入力フォーム ---
-                            # 各入力ウィジェットに一意なキーを設定 (df_indexを使用)
-                            new_treatment = st.text_input(
-                                "✂️ 施術内容",
-                                selected_row.get("施術内容", ""), # .getで欠損値対応
-                                key=f"edit_treat_{df_index}"
-                            )
-
-                            # 日付入力: st.date_input は datetime.date オブジェクトを扱う
-                            current_date_obj = None
-                            if pd.notna(selected_row.get("日付")):
-                                try:
-                                    current_date_obj = pd.to_datetime(selected_row["日付"]).date()
-                                except ValueError:
-                                    st.warning("既存の日付データが不正な形式です。")
-                            new_date = st.date_input(
-                                "📅 日付",
-                                current_date_obj, # dateオブジェクトまたはNone
-                                key=f"edit_date_{df_index}"
-                            )
-
-                            new_memo = st.text_area(
-                                "📝 施術メモ",
-                                selected_row.get("施術メモ", ""), # .getで欠損値対応
-                                key=f"edit_memo_{df_index}"
-                            )
-                            # --- 入力フォームここまで ---
-
-                            # 保存ボタン (一意なキーを設定)
-                            if st.button("💾 保存", key=f"save_edit_{df_index}"):
-                                # 更新データの辞書を作成 (キーはシートのヘッダー名と一致させる)
-                                updates = {
-                                    "施術内容": new_treatment,
-                                    "日付": str(new_date) if new_date else "", # シートには文字列 YYYY-MM-DD で保存
-                                    "施術メモ": new_memo
-                                    # 注意: 顧客名や写真URLを更新する場合はここに追加
-                                }
-                                # 修正した update_treatment を呼び出し (DataFrameのインデックスを渡す)
-                                if update_treatment(df_index, updates):
-                                     # 更新成功したら画面を再読み込みして変更を反映
-                                     st.rerun()
-                        else:
-                            st.error("選択された編集候補に一致するデータが見つかりませんでした。")
-
+                        # ID をウィジェットのキーに使う (行がずれても入力状態が入れ替わらない)
+                        df_index = selected_row[ID_COLUMN]
+
+                        # --- 入力フォーム ---
+                        # 各入力ウィジェットに一意なキーを設定 (df_indexを使用)
+                        new_treatment = st.text_input(
+                            "✂️ 施術内容",
+                            selected_row.get("施術内容", ""), # .getで欠損値対応
+                            key=f"edit_treat_{df_index}"
+                        )
+
+                        # 日付入力: st.date_input は datetime.date オブジェクトを扱う
+                        # 日付は読み込み時に解釈済み (空欄・不正な形式は NaT)
+                        current_date_obj = None
+                        if pd.notna(selected_row.get("日付")):
+                            current_date_obj = selected_row["日付"].date()
+                        new_date = st.date_input(
+                            "📅 日付",
+                            current_date_obj, # dateオブジェクトまたはNone
+                            key=f"edit_date_{df_index}"
+                        )
+
+                        new_memo = st.text_area(
+                            "📝 施術メモ",
+                            selected_row.get("施術メモ", ""), # .getで欠損値対応
+                            key=f"edit_memo_{df_index}"
+                        )
+                        # --- 入力フォームここまで ---
+
+                        # 保存ボタン (一意なキーを設定)
+                        if st.button("💾 保存", key=f"save_edit_{df_index}"):
+                            # 更新データの辞書を作成 (キーはシートのヘッダー名と一致させる)
+                            updates = {
+                                "施術内容": new_treatment,
+                                "日付": str(new_date) if new_date else "", # シートには文字列 YYYY-MM-DD で保存
+                                "施術メモ": new_memo
+                                # 注意: 顧客名や写真URLを更新する場合はここに追加
+                            }
+                            # ID で行を特定して更新 (DataFrame のインデックスとシートの行がずれても安全)
+                            if update_treatment(selected_row[ID_COLUMN], updates):
+                                 # 更新成功したら画面を再読み込みして変更を反映
+                                 st.rerun()
                     except KeyError as e:
                          st.error(f"編集中に必要なデータが見つかりません (KeyError: {e})。データを確認してください。")
                     except Exception as e:
@@ -848,23 +2823,21 @@ def main():
                     
 
         with st.expander("🗑️ 施術履歴の削除"):
-            # 削除用の選択肢を作成（顧客名 | 施術内容 | 施術日）
-            df_treatments["削除候補"] = df_treatments.apply(
-                lambda row: f"{row['顧客名']} | {row['施術内容']} | {row['日付']}", axis=1
-            )
+            df_treatments = load_treatments_with_furigana()
 
-            # 施術履歴を選択肢に表示
-            delete_option = st.selectbox("👤 削除する施術履歴を選択", df_treatments["削除候補"].tolist())
+            if not df_treatments.empty:
+                # 編集と同じく、顧客 → 施術履歴の順に選ぶ
+                delete_row = select_treatment(df_treatments, "delete_treatment", "👤 削除する施術履歴を選択")
 
-            # 削除処理
-            if st.button("❌ 削除"):
-                # 選択されたデータを元に、元の `顧客名` を取得
-                delete_name = delete_option.split(" | ")[0]  # 顧客名を取得
-                delete_treatment(delete_name)  # 削除関数を実行
+                # 削除処理
+                if st.button("❌ 削除") and delete_row is not None:
+                    delete_treatment(delete_row[ID_COLUMN])  # 選択した施術履歴の行だけを削除
 
-                st.success(f"🗑️ {delete_option} の施術履歴を削除しました")
-                st.session_state["customer_updated"] = True  # 更新フラグをセット
-                st.rerun() 
+                    deleted_label = treatment_labels(df_treatments.loc[[delete_row.name]]).iloc[0]
+                    st.success(f"🗑️ {deleted_label} の施術履歴を削除しました")
+                    st.rerun()
+            else:
+                st.info("削除できる施術履歴がありません。")
     with tab4:
             st.subheader("🚪ログアウト")
             if st.button("ログアウト"):
@@ -886,20 +2859,42 @@ def main():
         if "selected_customer" not in st.session_state:
             st.session_state.selected_customer = None
 
+        # 着信番号から顧客を引く (1人に絞れればそのままカルテを表示)
+        phone_query = st.text_input("📞 電話番号で検索（全体または下4桁）", key="phone_customer_search")
+        phone_digits = normalize_phone_digits(phone_query)
+        if len(phone_digits) >= PHONE_LOOKUP_MIN_DIGITS:  # 入力途中 (3桁まで) は何も表示しない
+            matched_customers = lookup_customers_by_phone(load_customers(), phone_digits)
+            # 番号が変わったときだけ選び直す (名前検索で選んだ顧客を再実行のたびに上書きしない)
+            phone_changed = st.session_state.get("last_phone_query") != phone_digits
+            st.session_state.last_phone_query = phone_digits
+            if len(matched_customers) == 1:
+                if phone_changed:
+                    st.session_state.selected_customer = matched_customers["顧客名"].iloc[0]
+            elif len(matched_customers) > 1:
+                st.info(f"{len(matched_customers)} 件の顧客が該当しました。選択してください。")
+                if phone_changed:
+                    st.session_state.filtered_customers = matched_customers["顧客名"].tolist()
+            else:
+                st.error("該当する電話番号の顧客が見つかりませんでした。")
+        else:
+            st.session_state.last_phone_query = None  # 入力し直したら同じ番号でもまた選ぶ
+
+        # 入力のたびに候補を更新 (タイプアヘッド)。候補は前方一致で引き、前方一致がないときと
+        # ボタンを押したときは部分一致 (名前の途中・空白なしのフリガナ) まで広げる
+        show_clicked = st.button("顧客情報を表示", key="show_customer_info")
+        if search_query:
+            df_customers = load_customers()
+            positions = [] if show_clicked else search_customers(
+                df_customers, search_query, limit=CUSTOMER_SUGGESTION_LIMIT, substring=False)
+            if not positions:
+                positions = search_customers(df_customers, search_query, limit=CUSTOMER_SUGGESTION_LIMIT)
+            st.session_state.filtered_customers = df_customers["顧客名"].iloc[positions].tolist() if positions else []
+
         # 顧客情報を検索
-        if st.button("顧客情報を表示", key="show_customer_info"):
+        if show_clicked:
             if search_query:
-                df_customers = load_customers()
-                filtered_customers = df_customers[
-                    df_customers["顧客名"].str.contains(search_query, na=False, case=False) |
-                    df_customers["フリガナ"].str.contains(search_query, na=False, case=False)
-                ]
-                
-                if not filtered_customers.empty:
-                    st.session_state.filtered_customers = filtered_customers["顧客名"].tolist()
-                else:
+                if not st.session_state.filtered_customers:
                     st.error("該当する顧客が見つかりませんでした。")
-                    st.session_state.filtered_customers = []
             else:
                 st.warning("顧客名またはフリガナを入力してください。")
 
@@ -914,6 +2909,11 @@ def main():
         # 選択した顧客の情報を表示
         if st.session_state.selected_customer:
             customer_details_view(st.session_state.selected_customer)
+
+    # 管理用: この再実行までの Google API 呼び出しの集計
+    if SHOW_DIAGNOSTICS:
+        show_api_call_panel()
                     
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
+    get_startup_report().mark_first_render()
\ No newline at end of file